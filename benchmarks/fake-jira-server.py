@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2025 Dustin Black
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===
+
+Local stand-in for the Jira Cloud REST API endpoints used by jira-report.py, serving
+a synthetic dataset so that the report can be benchmarked without a real instance.
+
+Request and byte counters, and the time the first request arrived, are available
+from GET /_stats.
+"""
+
+import re
+import sys
+import json
+import random
+import threading
+from time import sleep, time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+EPIC_LINK_FIELD = "customfield_10014"
+
+parser = ArgumentParser(
+    description="Fake Jira Cloud REST server with a synthetic dataset",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+
+parser.add_argument(
+    "-p",
+    "--port",
+    type=int,
+    dest="port",
+    required=False,
+    default=0,
+    help="Port to listen on (0 picks a free port, which is printed on startup)",
+)
+parser.add_argument(
+    "-n",
+    "--issues",
+    type=int,
+    dest="issue_count",
+    required=False,
+    default=100,
+    help="Number of issues returned by the report query",
+)
+parser.add_argument(
+    "-c",
+    "--comments",
+    type=int,
+    dest="comments_per_issue",
+    required=False,
+    default=5,
+    help="Number of comments on each issue",
+)
+parser.add_argument(
+    "-F",
+    "--epic-fan-out",
+    type=int,
+    dest="epic_fan_out",
+    required=False,
+    default=10,
+    help="Number of issues linked to each epic (0 for no epics)",
+)
+parser.add_argument(
+    "-t",
+    "--subtask-ratio",
+    type=float,
+    dest="subtask_ratio",
+    required=False,
+    default=0.2,
+    help="Fraction of issues that are subtasks of another issue",
+)
+parser.add_argument(
+    "-b",
+    "--comment-bytes",
+    type=int,
+    dest="comment_bytes",
+    required=False,
+    default=400,
+    help="Approximate size of each comment body",
+)
+parser.add_argument(
+    "-d",
+    "--latency-ms",
+    type=float,
+    dest="latency_ms",
+    required=False,
+    default=0,
+    help="Artificial delay added to every response",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    dest="seed",
+    required=False,
+    default=1,
+    help="Random seed for the synthetic dataset",
+)
+
+args = parser.parse_args()
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor"
+    " incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud"
+    " exercitation ullamco laboris nisi aliquip ex ea commodo consequat"
+).split()
+OWNERS = [f"Owner {n}" for n in range(1, 13)]
+STATUSES = ["New", "In Progress", "Review", "Closed"]
+
+
+def sentence(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+    return " ".join(words).capitalize() + "."
+
+
+def build_dataset():
+    """Return the report issues and a lookup of every issue (including epics) by key"""
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    all_issues = {}
+
+    epic_count = (
+        -(-args.issue_count // args.epic_fan_out) if args.epic_fan_out > 0 else 0
+    )
+    for number in range(1, epic_count + 1):
+        key = f"EPIC-{number}"
+        all_issues[key] = {
+            "id": str(100000 + number),
+            "key": key,
+            "fields": {"summary": f"Epic {number}: {sentence(rng, 40)}"},
+        }
+
+    report_issues = []
+    subtask_count = int(args.issue_count * args.subtask_ratio)
+    for number in range(1, args.issue_count + 1):
+        key = f"BENCH-{number}"
+        # The first issues are the parents, the last ones are their subtasks
+        is_subtask = number > args.issue_count - subtask_count
+        comments = []
+        for comment_number in range(args.comments_per_issue):
+            author = "jira-bot" if rng.random() < 0.1 else rng.choice(OWNERS)
+            comments.append(
+                {
+                    "id": str(comment_number),
+                    "author": {"displayName": author},
+                    "body": sentence(rng, args.comment_bytes),
+                }
+            )
+        owner = rng.choice(OWNERS + [None])
+        updated = now - timedelta(days=rng.randint(0, 30), minutes=rng.randint(0, 1440))
+        fields = {
+            "issuetype": {
+                "name": "Sub-task" if is_subtask else "Story",
+                "subtask": is_subtask,
+            },
+            "parent": None,
+            "comment": {
+                "comments": comments,
+                "maxResults": len(comments),
+                "total": len(comments),
+                "startAt": 0,
+            },
+            "assignee": {"displayName": owner} if owner else None,
+            "creator": {"displayName": rng.choice(OWNERS)},
+            "status": {"name": rng.choice(STATUSES)},
+            "updated": updated.strftime("%Y-%m-%dT%H:%M:%S.000%z"),
+            "summary": sentence(rng, 60),
+            EPIC_LINK_FIELD: None,
+        }
+        if is_subtask:
+            parent = rng.randint(1, max(1, args.issue_count - subtask_count))
+            fields["parent"] = {"key": f"BENCH-{parent}"}
+        elif epic_count:
+            fields[EPIC_LINK_FIELD] = f"EPIC-{(number - 1) // args.epic_fan_out + 1}"
+        issue = {"id": str(number), "key": key, "fields": fields}
+        report_issues.append(issue)
+        all_issues[key] = issue
+
+    return report_issues, all_issues
+
+
+report_issues, all_issues = build_dataset()
+
+FIELDS = [
+    {"id": "summary", "name": "Summary", "custom": False, "clauseNames": ["summary"]},
+    {"id": "status", "name": "Status", "custom": False, "clauseNames": ["status"]},
+    {"id": "updated", "name": "Updated", "custom": False, "clauseNames": ["updated"]},
+    {
+        "id": "assignee",
+        "name": "Assignee",
+        "custom": False,
+        "clauseNames": ["assignee"],
+    },
+    {
+        "id": EPIC_LINK_FIELD,
+        "name": "Epic Link",
+        "custom": True,
+        "clauseNames": ["cf[10014]", "Epic Link"],
+    },
+]
+
+single_issue_re = re.compile(r"^\s*(?:issue|key)\s*=\s*([A-Z]+-\d+)\s*$", re.IGNORECASE)
+# Key ranges of the shards of jira-report.py --shards with --shard-by key
+key_range_re = re.compile(
+    r"issuekey\s*>=\s*([A-Z]+)-(\d+)\s+AND\s+issuekey\s*<=\s*\1-(\d+)",
+    re.IGNORECASE,
+)
+
+stats_lock = threading.Lock()
+stats = {
+    "requests": 0,
+    "bytes_sent": 0,
+    "bytes_received": 0,
+    "endpoints": {},
+    "first_request_time": None,
+}
+
+
+def select_fields(issue, fields):
+    if not fields or "*all" in fields:
+        return issue
+    return {
+        "id": issue["id"],
+        "key": issue["key"],
+        "fields": {
+            name: value for name, value in issue["fields"].items() if name in fields
+        },
+    }
+
+
+def in_key_ranges(issue, ranges):
+    project, number = issue["key"].rsplit("-", 1)
+    return any(
+        project == range_project.upper() and int(low) <= int(number) <= int(high)
+        for range_project, low, high in ranges
+    )
+
+
+def search(params):
+    jql = params.get("jql", [""])[0]
+    fields = []
+    for value in params.get("fields", []):
+        fields.extend(field for field in value.split(",") if field)
+    max_results = int(params.get("maxResults", ["50"])[0])
+    start = int(params.get("nextPageToken", params.get("startAt", ["0"]))[0])
+
+    single_issue = single_issue_re.match(jql)
+    if single_issue:
+        if single_issue.group(1) not in all_issues:
+            return 400, {"errorMessages": ["Issue does not exist"], "errors": {}}
+        matches = [all_issues[single_issue.group(1)]]
+    elif key_range_re.search(jql):
+        ranges = key_range_re.findall(jql)
+        matches = [issue for issue in report_issues if in_key_ranges(issue, ranges)]
+    else:
+        matches = report_issues
+
+    page = [
+        select_fields(issue, fields) for issue in matches[start:start + max_results]
+    ]
+    result = {
+        "startAt": start,
+        "maxResults": max_results,
+        "total": len(matches),
+        "issues": page,
+        "isLast": start + max_results >= len(matches),
+    }
+    if not result["isLast"]:
+        result["nextPageToken"] = str(start + max_results)
+    return 200, result
+
+
+class FakeJiraHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *log_args):
+        pass
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        return len(payload)
+
+    def handle_request(self, params):
+        url = urlparse(self.path)
+        endpoint = url.path.rstrip("/")
+
+        if endpoint == "/_stats":
+            with stats_lock:
+                self.respond(200, stats)
+            return
+
+        with stats_lock:
+            if stats["first_request_time"] is None:
+                stats["first_request_time"] = time()
+
+        if args.latency_ms:
+            sleep(args.latency_ms / 1000)
+
+        status = 200
+        if endpoint.endswith("/serverInfo"):
+            body = {
+                "baseUrl": f"http://{self.headers.get('Host')}",
+                "version": "1001.0.0-SNAPSHOT",
+                "versionNumbers": [1001, 0, 0],
+                "deploymentType": "Cloud",
+                "buildNumber": 100000,
+                "serverTitle": "Fake Jira",
+            }
+        elif endpoint.endswith("/field"):
+            body = FIELDS
+        elif endpoint.endswith("/search/approximate-count"):
+            single_issue = single_issue_re.match(params.get("jql", [""])[0])
+            body = {"count": 1 if single_issue else len(report_issues)}
+        elif endpoint.endswith("/search/jql") or endpoint.endswith("/search"):
+            status, body = search(params)
+        else:
+            status, body = 404, {"errorMessages": ["Not found"]}
+        self.count(endpoint, self.respond(status, body))
+
+    def count(self, endpoint, bytes_sent):
+        name = endpoint.rsplit("/rest/api/", 1)[-1]
+        with stats_lock:
+            stats["requests"] += 1
+            stats["bytes_sent"] += bytes_sent
+            stats["bytes_received"] += len(self.requestline) + sum(
+                len(key) + len(value) + 4 for key, value in self.headers.items()
+            )
+            stats["endpoints"][name] = stats["endpoints"].get(name, 0) + 1
+
+    def do_GET(self):
+        self.handle_request(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with stats_lock:
+            stats["bytes_received"] += length
+        params = {
+            key: [",".join(value)] if isinstance(value, list) else [str(value)]
+            for key, value in body.items()
+        }
+        self.handle_request(params)
+
+
+server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeJiraHandler)
+print(f"Fake Jira listening on port {server.server_address[1]}", flush=True)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    sys.exit(0)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2025 Dustin Black
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===
+
+Local stand-in for an OpenAI-compatible /v1/chat/completions endpoint, so that the
+AI summary path of jira-report.py can be benchmarked without spending real tokens.
+
+Request, status code and latency counters are available from GET /_stats.
+"""
+
+import sys
+import json
+import math
+import random
+import threading
+from time import sleep, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+parser = ArgumentParser(
+    description="Fake OpenAI-compatible chat completions server",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+
+parser.add_argument(
+    "-p",
+    "--port",
+    type=int,
+    dest="port",
+    required=False,
+    default=0,
+    help="Port to listen on (0 picks a free port, which is printed on startup)",
+)
+parser.add_argument(
+    "-D",
+    "--latency-distribution",
+    type=str,
+    dest="latency_distribution",
+    required=False,
+    choices=("fixed", "uniform", "normal", "lognormal"),
+    default="fixed",
+    help="Distribution of the response latency",
+)
+parser.add_argument(
+    "-d",
+    "--latency-ms",
+    type=float,
+    dest="latency_ms",
+    required=False,
+    default=0,
+    help="Mean response latency (the median for lognormal)",
+)
+parser.add_argument(
+    "-s",
+    "--latency-spread-ms",
+    type=float,
+    dest="latency_spread_ms",
+    required=False,
+    default=0,
+    help=(
+        "Spread of the response latency: the half-width for uniform or the standard"
+        " deviation for normal and lognormal"
+    ),
+)
+parser.add_argument(
+    "-e",
+    "--error-rate",
+    type=float,
+    dest="error_rate",
+    required=False,
+    default=0,
+    help="Fraction of requests that fail with a 500 error",
+)
+parser.add_argument(
+    "-r",
+    "--rate-limit-rate",
+    type=float,
+    dest="rate_limit_rate",
+    required=False,
+    default=0,
+    help="Fraction of requests that are rejected with a 429 response",
+)
+parser.add_argument(
+    "-c",
+    "--max-concurrency",
+    type=int,
+    dest="max_concurrency",
+    required=False,
+    default=0,
+    help="Reject requests beyond this many in flight with a 429 (0 is no limit)",
+)
+parser.add_argument(
+    "-b",
+    "--response-bytes",
+    type=int,
+    dest="response_bytes",
+    required=False,
+    default=300,
+    help="Approximate size of each completion",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    dest="seed",
+    required=False,
+    default=1,
+    help="Random seed for latencies and failures",
+)
+
+args = parser.parse_args()
+
+rng = random.Random(args.seed)
+rng_lock = threading.Lock()
+
+stats_lock = threading.Lock()
+stats = {
+    "requests": 0,
+    "status_codes": {},
+    "in_flight": 0,
+    "max_in_flight": 0,
+    "prompt_bytes": 0,
+    "bytes_sent": 0,
+    "latency_ms_total": 0.0,
+}
+
+
+def draw_latency():
+    """Return a response latency in seconds from the configured distribution"""
+    mean = args.latency_ms
+    spread = args.latency_spread_ms
+    with rng_lock:
+        if args.latency_distribution == "uniform":
+            latency = rng.uniform(mean - spread, mean + spread)
+        elif args.latency_distribution == "normal":
+            latency = rng.gauss(mean, spread)
+        elif args.latency_distribution == "lognormal" and mean > 0:
+            latency = rng.lognormvariate(math.log(mean), spread / mean)
+        else:
+            latency = mean
+    return max(latency, 0) / 1000
+
+
+def draw_failure():
+    """Return the failure status code for a request, or None if it should succeed"""
+    with rng_lock:
+        roll = rng.random()
+    if roll < args.error_rate:
+        return 500
+    if roll < args.error_rate + args.rate_limit_rate:
+        return 429
+    return None
+
+
+def completion_text(size):
+    text = "The work is progressing as planned with no blockers reported."
+    return (text + " ") * (size // (len(text) + 1)) + text
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *log_args):
+        pass
+
+    def respond(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        with stats_lock:
+            stats["bytes_sent"] += len(payload)
+            stats["status_codes"][str(status)] = (
+                stats["status_codes"].get(str(status), 0) + 1
+            )
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/_stats":
+            with stats_lock:
+                self.respond(200, stats)
+        else:
+            self.respond(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.respond(404, {"error": {"message": "Not found"}})
+            return
+
+        with stats_lock:
+            stats["requests"] += 1
+            stats["prompt_bytes"] += length
+            stats["in_flight"] += 1
+            stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+            over_capacity = (
+                args.max_concurrency and stats["in_flight"] > args.max_concurrency
+            )
+        try:
+            failure = 429 if over_capacity else draw_failure()
+            if failure == 429:
+                self.respond(
+                    429,
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit"}},
+                    headers={"Retry-After": "1"},
+                )
+                return
+
+            latency = draw_latency()
+            sleep(latency)
+            with stats_lock:
+                stats["latency_ms_total"] += latency * 1000
+
+            if failure == 500:
+                self.respond(500, {"error": {"message": "Internal server error"}})
+                return
+
+            prompt = "".join(
+                str(message.get("content", "")) for message in request["messages"]
+            )
+            content = completion_text(args.response_bytes)
+            self.respond(
+                200,
+                {
+                    "id": f"chatcmpl-{stats['requests']}",
+                    "object": "chat.completion",
+                    "created": int(time()),
+                    "model": request.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": len(prompt) // 4,
+                        "completion_tokens": len(content) // 4,
+                        "total_tokens": (len(prompt) + len(content)) // 4,
+                    },
+                },
+            )
+        finally:
+            with stats_lock:
+                stats["in_flight"] -= 1
+
+
+server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeLLMHandler)
+print(f"Fake LLM listening on port {server.server_address[1]}", flush=True)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    sys.exit(0)
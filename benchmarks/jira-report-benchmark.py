@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2025 Dustin Black
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===
+
+Offline benchmark suite for jira-report.py. Each scenario starts
+fake-jira-server.py with a synthetic dataset (and fake-llm-server.py for scenarios
+with AI summaries) and runs the report end to end against it in local mode,
+recording wall time, request counts, bytes transferred and the peak RSS of the
+report process. Scenarios with shards run the report as a sharded job with local
+worker processes. Scenarios with a memory budget run the report with
+--memory-budget, so that a memory regression fails the scenario.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import threading
+from time import perf_counter
+from urllib.request import urlopen
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import yaml
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+report_script = os.path.join(os.path.dirname(bench_dir), "jira-report.py")
+
+parser = ArgumentParser(
+    description="Offline benchmark suite for jira-report.py",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+
+parser.add_argument(
+    "-i",
+    "--input",
+    type=str,
+    dest="input_path",
+    required=False,
+    default=os.path.join(bench_dir, "scenarios.yaml"),
+    help="The path to the YAML scenarios file",
+)
+parser.add_argument(
+    "-n",
+    "--scenario",
+    type=str,
+    dest="scenarios",
+    action="append",
+    required=False,
+    help="Only run the named scenario (may be repeated)",
+)
+parser.add_argument(
+    "-r",
+    "--repeat",
+    type=int,
+    dest="repeat",
+    required=False,
+    default=1,
+    help="Number of runs per scenario; the fastest run is reported",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    dest="output_path",
+    required=False,
+    help="Write the results as JSON to this path",
+)
+parser.add_argument(
+    "-b",
+    "--baseline",
+    type=str,
+    dest="baseline_path",
+    required=False,
+    help="JSON results from an earlier run to compare against",
+)
+parser.add_argument(
+    "-t",
+    "--max-regression",
+    type=float,
+    dest="max_regression",
+    required=False,
+    default=20.0,
+    help=(
+        "Fail if wall time, peak RSS or bytes transferred grow by more than this"
+        " percentage (or Jira or LLM request counts grow at all) compared to the"
+        " baseline"
+    ),
+)
+
+args = parser.parse_args()
+
+try:
+    with open(args.input_path, "r") as stream:
+        scenarios = yaml.safe_load(stream)["benchmark_scenarios"]
+except (OSError, KeyError, yaml.YAMLError):
+    print("Error reading input file!")
+    sys.exit(1)
+
+if args.scenarios:
+    scenarios = [s for s in scenarios if s["name"] in args.scenarios]
+
+
+def start_server(script, options):
+    """Start a fake server script and return the process and the port it bound"""
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(bench_dir, script), *options],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    banner = server.stdout.readline()
+    if not banner:
+        server.wait()
+        print(f"{script} failed to start")
+        sys.exit(1)
+    return server, int(banner.split()[-1])
+
+
+def server_stats(port):
+    with urlopen(f"http://127.0.0.1:{port}/_stats") as response:
+        return json.load(response)
+
+
+def run_report(report_args):
+    """Run jira-report.py and return its wall time, peak RSS in KiB, exit status and
+    run metrics"""
+    metrics_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    metrics_file.close()
+    start = perf_counter()
+    report = subprocess.Popen(
+        [sys.executable, report_script, *report_args, "-M", metrics_file.name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    output = report.stdout.read()
+    # wait4 gives the resource usage of this child alone
+    _, status, rusage = os.wait4(report.pid, 0)
+    wall_time = perf_counter() - start
+    # Let Popen know the child has already been reaped
+    report.returncode = os.waitstatus_to_exitcode(status)
+    if report.returncode != 0:
+        print("\n".join(output.splitlines()[-20:]))
+    try:
+        with open(metrics_file.name, "r") as stream:
+            metrics = json.load(stream)
+    except ValueError:
+        metrics = {}
+    os.remove(metrics_file.name)
+    return wall_time, rusage.ru_maxrss, report.returncode, metrics
+
+
+def llm_server_options(llm):
+    return [
+        "--latency-distribution",
+        llm.get("latency_distribution", "fixed"),
+        "--latency-ms",
+        str(llm.get("latency_ms", 0)),
+        "--latency-spread-ms",
+        str(llm.get("latency_spread_ms", 0)),
+        "--error-rate",
+        str(llm.get("error_rate", 0)),
+        "--rate-limit-rate",
+        str(llm.get("rate_limit_rate", 0)),
+        "--max-concurrency",
+        str(llm.get("max_concurrency", 0)),
+        "--response-bytes",
+        str(llm.get("response_bytes", 300)),
+    ]
+
+
+def run_reports(report_args, concurrency):
+    """Run concurrent copies of jira-report.py and return their results"""
+    runs = [None] * concurrency
+
+    def run(index):
+        runs[index] = run_report(report_args)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return runs
+
+
+def run_scenario(scenario):
+    jira_options = [
+        "--issues",
+        str(scenario["issues"]),
+        "--comments",
+        str(scenario["comments"]),
+        "--epic-fan-out",
+        str(scenario["epic_fan_out"]),
+        "--subtask-ratio",
+        str(scenario["subtask_ratio"]),
+        "--comment-bytes",
+        str(scenario.get("comment_bytes", 400)),
+        "--latency-ms",
+        str(scenario.get("latency_ms", 0)),
+    ]
+
+    concurrency = scenario.get("concurrency", 1)
+
+    best = None
+    for _ in range(args.repeat):
+        servers = []
+        shard_dir = None
+        try:
+            jira_server, jira_port = start_server("fake-jira-server.py", jira_options)
+            servers.append(jira_server)
+            report_args = [
+                "-S",
+                f"http://127.0.0.1:{jira_port}",
+                "-E",
+                "bench@example.com",
+                "-T",
+                "bench-token",
+                "-J",
+                "project = BENCH",
+                "-u",
+                "bench@example.com",
+                "-l",
+            ]
+            if "shards" in scenario:
+                shard_dir = tempfile.mkdtemp(prefix="jira-report-shards-")
+                report_args.extend(
+                    ["--shards", str(scenario["shards"]), "--shard-dir", shard_dir]
+                )
+            if "memory_budget_mb" in scenario:
+                report_args.extend(
+                    ["--memory-budget", str(scenario["memory_budget_mb"])]
+                )
+            if "llm" in scenario:
+                llm_server, llm_port = start_server(
+                    "fake-llm-server.py", llm_server_options(scenario["llm"])
+                )
+                servers.append(llm_server)
+                report_args.extend(
+                    [
+                        "-L",
+                        f"http://127.0.0.1:{llm_port}",
+                        "-I",
+                        "bench-model",
+                        "-K",
+                        "bench-token",
+                    ]
+                )
+            runs = run_reports(report_args, concurrency)
+            jira_stats = server_stats(jira_port)
+            llm_stats = server_stats(llm_port) if "llm" in scenario else None
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+            if shard_dir:
+                shutil.rmtree(shard_dir)
+
+        wall_times = [run[0] for run in runs]
+        result = {
+            "wall_time": round(max(wall_times), 3),
+            "mean_wall_time": round(sum(wall_times) / len(wall_times), 3),
+            "peak_rss_kib": max(run[1] for run in runs),
+            "jira_requests": jira_stats["requests"],
+            "jira_bytes_sent": jira_stats["bytes_sent"],
+            "jira_bytes_received": jira_stats["bytes_received"],
+            "jira_endpoints": jira_stats["endpoints"],
+            "returncode": max(run[2] for run in runs),
+            "phases": runs[0][3].get("phases", {}),
+        }
+        if "memory_budget_mb" in scenario:
+            result["traced_peak_bytes"] = max(
+                (
+                    phase["peak_bytes"]
+                    for run in runs
+                    for phase in run[3].get("memory", {}).values()
+                ),
+                default=0,
+            )
+        if llm_stats:
+            successes = llm_stats["status_codes"].get("200", 0)
+            result.update(
+                {
+                    "llm_requests": llm_stats["requests"],
+                    "llm_retries": llm_stats["requests"] - successes,
+                    "llm_status_codes": llm_stats["status_codes"],
+                    "llm_max_in_flight": llm_stats["max_in_flight"],
+                    "llm_prompt_bytes": llm_stats["prompt_bytes"],
+                    "llm_bytes_sent": llm_stats["bytes_sent"],
+                }
+            )
+        if best is None or result["wall_time"] < best["wall_time"]:
+            best = result
+    return best
+
+
+results = {}
+for scenario in scenarios:
+    print(f"Running scenario {scenario['name']}...", flush=True)
+    results[scenario["name"]] = run_scenario(scenario)
+
+print(
+    f"\n{'scenario':<20} {'wall (s)':>9} {'peak RSS (KiB)':>15} {'requests':>9}"
+    f" {'bytes in':>11} {'bytes out':>10} {'LLM calls':>10} {'LLM retries':>12}"
+)
+for name, result in results.items():
+    print(
+        f"{name:<20} {result['wall_time']:>9.3f} {result['peak_rss_kib']:>15}"
+        f" {result['jira_requests']:>9} {result['jira_bytes_sent']:>11}"
+        f" {result['jira_bytes_received']:>10} {result.get('llm_requests', '-'):>10}"
+        f" {result.get('llm_retries', '-'):>12}"
+    )
+
+if args.output_path:
+    with open(args.output_path, "w") as stream:
+        json.dump(results, stream, indent=2)
+
+failed = [name for name, result in results.items() if result["returncode"] != 0]
+for name in failed:
+    print(f"Scenario {name}: jira-report.py failed")
+
+if args.baseline_path:
+    with open(args.baseline_path, "r") as stream:
+        baseline = json.load(stream)
+    limit = 1 + args.max_regression / 100
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in (
+            "wall_time",
+            "peak_rss_kib",
+            "jira_bytes_sent",
+            "traced_peak_bytes",
+        ):
+            if metric not in result or metric not in baseline[name]:
+                continue
+            if result[metric] > baseline[name][metric] * limit:
+                print(
+                    f"Scenario {name}: {metric} regressed from"
+                    f" {baseline[name][metric]} to {result[metric]}"
+                )
+                failed.append(name)
+        for metric in ("jira_requests", "llm_requests"):
+            if result.get(metric, 0) > baseline[name].get(metric, 0):
+                print(
+                    f"Scenario {name}: {metric} regressed from"
+                    f" {baseline[name].get(metric, 0)} to {result.get(metric, 0)}"
+                )
+                failed.append(name)
+
+if failed:
+    sys.exit(1)
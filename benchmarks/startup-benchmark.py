@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Copyright 2025 Dustin Black
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+===
+
+Cold start benchmark for jira-report.py. Measures the time until argparse is done
+(using --help) and the time from launch until the first request reaches
+fake-jira-server.py, and checks that --help does not load the heavy modules.
+"""
+
+import os
+import sys
+import json
+import subprocess
+from time import perf_counter, time
+from statistics import median
+from urllib.request import urlopen
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+report_script = os.path.join(os.path.dirname(bench_dir), "jira-report.py")
+
+# Modules that must not be imported before the code paths that need them
+LAZY_MODULES = (
+    "jira",
+    "requests",
+    "smtplib",
+    "email.mime.text",
+    "pprint",
+    "sqlite3",
+)
+
+parser = ArgumentParser(
+    description="Cold start benchmark for jira-report.py",
+    formatter_class=ArgumentDefaultsHelpFormatter,
+)
+
+parser.add_argument(
+    "-r",
+    "--repeat",
+    type=int,
+    dest="repeat",
+    required=False,
+    default=10,
+    help="Number of runs per measurement; the median is reported",
+)
+parser.add_argument(
+    "-a",
+    "--max-argparse-ms",
+    type=float,
+    dest="max_argparse_ms",
+    required=False,
+    help="Fail if the median time to argparse exceeds this many milliseconds",
+)
+parser.add_argument(
+    "-q",
+    "--max-first-request-ms",
+    type=float,
+    dest="max_first_request_ms",
+    required=False,
+    help="Fail if the median time to the first request exceeds this many milliseconds",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    dest="output_path",
+    required=False,
+    help="Write the results as JSON to this path",
+)
+parser.add_argument(
+    "-b",
+    "--baseline",
+    type=str,
+    dest="baseline_path",
+    required=False,
+    help="JSON results from an earlier run to compare against",
+)
+parser.add_argument(
+    "-t",
+    "--max-regression",
+    type=float,
+    dest="max_regression",
+    required=False,
+    default=20.0,
+    help="Fail if a median grows by more than this percentage over the baseline",
+)
+
+args = parser.parse_args()
+
+
+def time_to_argparse():
+    start = perf_counter()
+    subprocess.run(
+        [sys.executable, report_script, "--help"],
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return (perf_counter() - start) * 1000
+
+
+def time_to_first_request():
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(bench_dir, "fake-jira-server.py"), "-n", "1"],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        port = int(server.stdout.readline().split()[-1])
+        start = time()
+        subprocess.run(
+            [
+                sys.executable,
+                report_script,
+                "-S",
+                f"http://127.0.0.1:{port}",
+                "-E",
+                "bench@example.com",
+                "-T",
+                "bench-token",
+                "-J",
+                "project = BENCH",
+                "-u",
+                "bench@example.com",
+                "-l",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        with urlopen(f"http://127.0.0.1:{port}/_stats") as response:
+            first_request = json.load(response)["first_request_time"]
+    finally:
+        server.terminate()
+        server.wait()
+    return (first_request - start) * 1000
+
+
+def modules_loaded_by_help():
+    """Return the lazy modules that get imported when running --help"""
+    importtime = subprocess.run(
+        [sys.executable, "-X", "importtime", report_script, "--help"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    ).stderr
+    imported = {line.split("|")[-1].strip() for line in importtime.splitlines()}
+    return sorted(module for module in LAZY_MODULES if module in imported)
+
+
+results = {
+    "argparse_ms": round(median(time_to_argparse() for _ in range(args.repeat)), 1),
+    "first_request_ms": round(
+        median(time_to_first_request() for _ in range(args.repeat)), 1
+    ),
+    "help_imports": modules_loaded_by_help(),
+}
+
+print(f"Time to argparse (--help): {results['argparse_ms']} ms")
+print(f"Time to first Jira request: {results['first_request_ms']} ms")
+print(f"Heavy modules loaded by --help: {', '.join(results['help_imports']) or 'none'}")
+
+if args.output_path:
+    with open(args.output_path, "w") as stream:
+        json.dump(results, stream, indent=2)
+
+failed = False
+if results["help_imports"]:
+    print("Heavy modules must be imported lazily")
+    failed = True
+if args.max_argparse_ms and results["argparse_ms"] > args.max_argparse_ms:
+    print(f"Time to argparse exceeds {args.max_argparse_ms} ms")
+    failed = True
+if (
+    args.max_first_request_ms
+    and results["first_request_ms"] > args.max_first_request_ms
+):
+    print(f"Time to first request exceeds {args.max_first_request_ms} ms")
+    failed = True
+if args.baseline_path:
+    with open(args.baseline_path, "r") as stream:
+        baseline = json.load(stream)
+    limit = 1 + args.max_regression / 100
+    for metric in ("argparse_ms", "first_request_ms"):
+        if results[metric] > baseline[metric] * limit:
+            print(f"{metric} regressed from {baseline[metric]} to {results[metric]}")
+            failed = True
+
+if failed:
+    sys.exit(1)
@@ -20,6 +20,8 @@ import sys
 import os
 import subprocess
 import re
+import json
+import fcntl
 import datetime
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
@@ -166,6 +168,46 @@ parser.add_argument(
     required=True,
     help="The path to the YAML input file",
 )
+parser.add_argument(
+    "-o",
+    "--overlap-policy",
+    type=str,
+    dest="overlap_policy",
+    required=False,
+    choices=("skip", "queue", "coalesce"),
+    default="skip",
+    help=(
+        "What to do if the job is still running when it is triggered again: skip"
+        " the new run, queue at most one run behind it, or coalesce all overlapping"
+        " triggers into a single follow-up run (overridden by the job's"
+        " overlap_policy in the YAML input)"
+    ),
+)
+parser.add_argument(
+    "-d",
+    "--state-dir",
+    type=str,
+    dest="state_dir",
+    required=False,
+    default=os.environ.get("jira_report_state_dir", "/var/tmp/jira-report"),
+    help="Directory for per-job lock files and the run history state file",
+)
+parser.add_argument(
+    "--history-limit",
+    type=int,
+    dest="history_limit",
+    required=False,
+    default=100,
+    help="Number of runs to keep in the run history for each job",
+)
+parser.add_argument(
+    "--show-history",
+    action="store_true",
+    dest="show_history",
+    required=False,
+    default=False,
+    help="Print the recorded run history for the job and exit",
+)
 
 args = parser.parse_args()
 
@@ -181,6 +223,113 @@ for job in jobs["jira_report_jobs"]:
         myjob = job
         break
 
+job_id = myjob["job_id"]
+os.makedirs(args.state_dir, exist_ok=True)
+history_path = os.path.join(args.state_dir, "run-history.json")
+summary_path = os.path.join(args.state_dir, "metrics-summary.json")
+metrics_path = os.path.join(args.state_dir, f"{job_id}.metrics.json")
+
+
+def acquire_lock(path, blocking=False):
+    """Take an exclusive flock on path, or return None if it is already held"""
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def release_lock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+def load_state(path):
+    try:
+        with open(path, "r") as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    # Write to a temp file first so a crash never leaves a truncated state file
+    with open(f"{path}.tmp", "w") as stream:
+        json.dump(state, stream, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def aggregate_metrics(jobs_metrics):
+    """Sum the phase timings and request histograms of every job's latest run"""
+    totals = {"phases": {}, "requests": {}}
+    for metrics in jobs_metrics.values():
+        for phase, values in metrics.get("phases", {}).items():
+            total = totals["phases"].setdefault(phase, {"seconds": 0, "calls": 0})
+            total["seconds"] = round(total["seconds"] + values["seconds"], 6)
+            total["calls"] += values["calls"]
+        for api, values in metrics.get("requests", {}).items():
+            total = totals["requests"].setdefault(
+                api, {"count": 0, "seconds": 0, "max_seconds": 0, "buckets": {}}
+            )
+            total["count"] += values["count"]
+            total["seconds"] = round(total["seconds"] + values["seconds"], 6)
+            total["max_seconds"] = max(total["max_seconds"], values["max_seconds"])
+            for le, count in values["buckets"].items():
+                total["buckets"][le] = total["buckets"].get(le, 0) + count
+    return totals
+
+
+def record_run(start, end, outcome, metrics=None):
+    """Append a run to the job's history and fold its metrics into the summary"""
+    history_lock = acquire_lock(f"{history_path}.lock", blocking=True)
+    try:
+        history = load_state(history_path)
+        runs = history.setdefault(job_id, [])
+        run = {
+            "start": start.isoformat(timespec="seconds"),
+            "end": end.isoformat(timespec="seconds"),
+            "duration": round((end - start).total_seconds(), 3),
+            "outcome": outcome,
+        }
+        if metrics:
+            run["phases"] = {
+                phase: values["seconds"]
+                for phase, values in metrics.get("phases", {}).items()
+            }
+        runs.append(run)
+        del runs[: -args.history_limit]
+        save_state(history_path, history)
+
+        if metrics:
+            summary = load_state(summary_path)
+            jobs_metrics = summary.get("jobs", {})
+            jobs_metrics[job_id] = metrics
+            save_state(
+                summary_path,
+                {"jobs": jobs_metrics, "totals": aggregate_metrics(jobs_metrics)},
+            )
+    finally:
+        release_lock(history_lock)
+
+
+if args.show_history:
+    runs = load_state(history_path).get(job_id, [])
+    for run in runs:
+        phases = ", ".join(
+            f"{phase} {seconds:.3f}s"
+            for phase, seconds in run.get("phases", {}).items()
+        )
+        print(f"{run['start']}  {run['duration']:>10.3f}s  {run['outcome']}  {phases}")
+    completed = [run["duration"] for run in runs if run["outcome"] == "success"]
+    if completed:
+        print(
+            f"{len(completed)} successful runs, average"
+            f" {sum(completed) / len(completed):.3f}s, latest {completed[-1]:.3f}s"
+        )
+    sys.exit(0)
+
 cmd = [
     "jira-report.py",
     "-S",
@@ -206,8 +355,40 @@ cmd = [
     ",".join(myjob["exclude_comment_authors"]),
     "-g",
     str(myjob["update_grace_days"]),
+    "-M",
+    metrics_path,
 ]
 
+# Only jobs with trends or digests keep snapshots, and only as long as they need
+if myjob.get("trend_weeks") or myjob.get("digest"):
+    cmd.extend(
+        [
+            "--history-db",
+            os.path.join(args.state_dir, "history.sqlite"),
+            "--job-name",
+            job_id,
+            "--history-weeks",
+            str(myjob.get("trend_weeks") or 1),
+        ]
+    )
+
+if myjob.get("trend_weeks"):
+    cmd.extend(["--trend-weeks", str(myjob["trend_weeks"])])
+
+if myjob.get("digest"):
+    cmd.append("--digest")
+
+if "max_issues" in myjob:
+    cmd.extend(["--max-issues", str(myjob["max_issues"])])
+
+if myjob.get("fragment_cache"):
+    cmd.extend(
+        ["--fragment-cache", os.path.join(args.state_dir, "fragments.sqlite")]
+    )
+
+if myjob.get("deadline_minutes"):
+    cmd.extend(["--deadline-minutes", str(myjob["deadline_minutes"])])
+
 if "enable_ai_summary" in myjob.keys() and myjob["enable_ai_summary"]:
     cmd.extend(
         [
@@ -256,13 +437,74 @@ if args.email_from:
 
 print(f"\n{' '.join(cmd)}")
 
-try:
-    cmd_out = subprocess.check_output(
-        cmd,
-        stderr=subprocess.STDOUT,
-        text=True,
-    )
-    print(f"Job completed:\n{cmd_out}")
-except subprocess.CalledProcessError as err:
-    print(f"{err.cmd[0]} failed with return code {err.returncode}:\n{err.output}")
+
+def run_job():
+    """Run the report once, record it in the history and return True on success"""
+    start = datetime.datetime.now()
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    try:
+        cmd_out = subprocess.check_output(
+            cmd,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        print(f"Job completed:\n{cmd_out}")
+        outcome = "success"
+    except subprocess.CalledProcessError as err:
+        print(f"{err.cmd[0]} failed with return code {err.returncode}:\n{err.output}")
+        outcome = "failed"
+    record_run(start, datetime.datetime.now(), outcome, load_state(metrics_path))
+    return outcome == "success"
+
+
+# Overlap protection: only one instance of a job may run at a time
+overlap_policy = myjob.get("overlap_policy", args.overlap_policy)
+if overlap_policy not in ("skip", "queue", "coalesce"):
+    print(f"Invalid overlap_policy for job {job_id}: {overlap_policy}")
+    sys.exit(1)
+
+lock_path = os.path.join(args.state_dir, f"{job_id}.lock")
+pending_path = os.path.join(args.state_dir, f"{job_id}.pending")
+run_lock = acquire_lock(lock_path)
+
+if run_lock is None and overlap_policy == "queue":
+    # Only one run may wait behind the active one; any further triggers are skipped
+    queue_lock = acquire_lock(os.path.join(args.state_dir, f"{job_id}.queue"))
+    if queue_lock is not None:
+        print(f"Job {job_id} is already running; queued behind it...")
+        run_lock = acquire_lock(lock_path, blocking=True)
+        release_lock(queue_lock)
+elif run_lock is None and overlap_policy == "coalesce":
+    # Leave a marker for the active run to pick up, then check whether it finished
+    # in the meantime so that the trigger is never lost
+    open(pending_path, "w").close()
+    run_lock = acquire_lock(lock_path)
+    if run_lock is None:
+        print(f"Job {job_id} is already running; coalesced into its follow-up run")
+        now = datetime.datetime.now()
+        record_run(now, now, "coalesced")
+        sys.exit(0)
+
+if run_lock is None:
+    print(f"Job {job_id} is already running; skipping this run")
+    now = datetime.datetime.now()
+    record_run(now, now, "skipped")
+    sys.exit(0)
+
+succeeded = True
+while run_lock is not None:
+    if os.path.exists(pending_path):
+        os.remove(pending_path)
+    succeeded = run_job() and succeeded
+    if overlap_policy != "coalesce" or not os.path.exists(pending_path):
+        release_lock(run_lock)
+        run_lock = None
+        # A trigger may have left its marker just before the lock was released
+        if overlap_policy == "coalesce" and os.path.exists(pending_path):
+            run_lock = acquire_lock(lock_path)
+    if run_lock is not None:
+        print(f"Job {job_id} was triggered while running; running it again...")
+
+if not succeeded:
     sys.exit(1)
@@ -23,15 +23,22 @@ Work inspired by:
 Copyright 2021 Joe Talerico
 """
 
+# Heavy modules (jira, requests, smtplib, email, sqlite3) are imported only on the
+# code paths that use them, so that --help and argument errors return quickly and
+# local runs never load the SMTP or LLM stacks. benchmarks/startup-benchmark.py
+# tracks this.
+import os
+import re
 import sys
-import pprint
-from time import sleep
-from requests import post
-from datetime import datetime
-from smtplib import SMTP_SSL
-from email.mime.text import MIMEText
+import json
+import atexit
+import threading
+from queue import Queue, Full, Empty
+from time import sleep, perf_counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from jira import JIRA, JIRAError
 from logger import logger
 
 
@@ -199,9 +206,272 @@ parser.add_argument(
         " --recipients is empty)"
     ),
 )
+parser.add_argument(
+    "-M",
+    "--metrics-file",
+    type=str,
+    dest="metrics_file",
+    required=False,
+    help="Write per-phase timings and API request latencies as JSON to this path",
+)
+parser.add_argument(
+    "-P",
+    "--prometheus-file",
+    type=str,
+    dest="prometheus_file",
+    required=False,
+    help=(
+        "Write per-phase timings and API request latencies in Prometheus text format"
+        " to this path (e.g. for the node_exporter textfile collector)"
+    ),
+)
+parser.add_argument(
+    "--memory-profile",
+    action="store_true",
+    dest="memory_profile",
+    required=False,
+    default=False,
+    help=(
+        "Trace memory allocations and record the peak traced memory and top"
+        " allocation sites of each phase in the run metrics"
+    ),
+)
+parser.add_argument(
+    "--memory-budget",
+    type=float,
+    dest="memory_budget",
+    required=False,
+    help=(
+        "Fail fast with a per-phase breakdown if traced memory exceeds this many MiB"
+        " (implies --memory-profile)"
+    ),
+)
+parser.add_argument(
+    "--record",
+    type=str,
+    dest="record_path",
+    required=False,
+    help=(
+        "Record every Jira and LLM HTTP exchange of the run, with credentials"
+        " redacted, to this gzip-compressed cassette file"
+    ),
+)
+parser.add_argument(
+    "--replay",
+    type=str,
+    dest="replay_path",
+    required=False,
+    help=(
+        "Serve Jira and LLM responses from this cassette file instead of the network"
+        " (implies --local)"
+    ),
+)
+parser.add_argument(
+    "--replay-latency",
+    action="store_true",
+    dest="replay_latency",
+    required=False,
+    default=False,
+    help="When replaying, delay each response by its recorded latency",
+)
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    dest="plan",
+    required=False,
+    default=False,
+    help=(
+        "Only estimate the cost of the report with cheap count and key-only queries,"
+        " without fetching comments, calling the LLM or sending email"
+    ),
+)
+parser.add_argument(
+    "--plan-max-issues",
+    type=int,
+    dest="plan_max_issues",
+    required=False,
+    help="With --plan, exit with an error if the query matches more issues than this",
+)
+parser.add_argument(
+    "--max-issues",
+    type=int,
+    dest="max_issues",
+    required=False,
+    help=(
+        "Only report the first this many issues of the query; 0 reports every issue"
+        " (defaults to 100, or to 0 for sharded reports)"
+    ),
+)
+parser.add_argument(
+    "--enrich-workers",
+    type=int,
+    dest="enrich_workers",
+    required=False,
+    default=4,
+    help="Number of concurrent epic and parent lookups",
+)
+parser.add_argument(
+    "--tldr-workers",
+    type=int,
+    dest="tldr_workers",
+    required=False,
+    default=4,
+    help="Number of concurrent AI TL;DR requests",
+)
+parser.add_argument(
+    "--queue-size",
+    type=int,
+    dest="queue_size",
+    required=False,
+    default=50,
+    help="Maximum number of issues waiting between two stages of the report pipeline",
+)
+parser.add_argument(
+    "--deadline-minutes",
+    type=float,
+    dest="deadline_minutes",
+    required=False,
+    help=(
+        "Deliver the report within this many minutes of the start of the run,"
+        " skipping AI requests and epic lookups that would not fit and marking the"
+        " degraded parts of the report"
+    ),
+)
+parser.add_argument(
+    "--deadline-reserve",
+    type=float,
+    dest="deadline_reserve",
+    required=False,
+    default=60,
+    help="Seconds of the deadline kept for rendering and delivering the report",
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    dest="shards",
+    required=False,
+    help=(
+        "Split the query into up to this many shards, run each one in a separate"
+        " worker process and merge their results into one report (requires"
+        " --shard-dir)"
+    ),
+)
+parser.add_argument(
+    "--shard-by",
+    type=str,
+    dest="shard_by",
+    required=False,
+    default="key",
+    choices=("key", "project", "updated"),
+    help="Split the query into shards by issue key ranges, projects or updated time",
+)
+parser.add_argument(
+    "--shard-dir",
+    type=str,
+    dest="shard_dir",
+    required=False,
+    help="Directory for the shard plan and the partial results of the shards",
+)
+parser.add_argument(
+    "--shard-step",
+    type=str,
+    dest="shard_step",
+    required=False,
+    choices=("plan", "work", "merge"),
+    help=(
+        "Only run one step of a sharded report, e.g. on separate nodes sharing"
+        " --shard-dir: write the shard plan, process the shard given by"
+        " --shard-index, or merge the shard results and deliver the report"
+    ),
+)
+parser.add_argument(
+    "--shard-workers",
+    type=int,
+    dest="shard_workers",
+    required=False,
+    default=4,
+    help=(
+        "Number of shard worker processes run at the same time; each has its own"
+        " --enrich-workers and --tldr-workers"
+    ),
+)
+parser.add_argument(
+    "--shard-index",
+    type=int,
+    dest="shard_index",
+    required=False,
+    help="With --shard-step work, the shard to process, counting from 0",
+)
+parser.add_argument(
+    "--history-db",
+    type=str,
+    dest="history_db",
+    required=False,
+    help="Append the processed issues of each run to this SQLite snapshot store",
+)
+parser.add_argument(
+    "--fragment-cache",
+    type=str,
+    dest="fragment_cache",
+    required=False,
+    help=(
+        "Reuse the rendered report of issues that did not change since an earlier"
+        " run from this SQLite cache, without epic lookups or AI TL;DR requests"
+    ),
+)
+parser.add_argument(
+    "--job-name",
+    type=str,
+    dest="job_name",
+    required=False,
+    help="Name of the report job in the snapshot store (defaults to the JQL query)",
+)
+parser.add_argument(
+    "--trend-weeks",
+    type=int,
+    dest="trend_weeks",
+    required=False,
+    default=0,
+    help=(
+        "Add trend sections covering this many weeks of the snapshot store to the"
+        " report (0 disables them; requires --history-db)"
+    ),
+)
+parser.add_argument(
+    "--history-weeks",
+    type=int,
+    dest="history_weeks",
+    required=False,
+    default=0,
+    help=(
+        "Drop the runs of the job older than this many weeks from the snapshot"
+        " store, always keeping the latest run (0 keeps every run)"
+    ),
+)
+parser.add_argument(
+    "--digest",
+    action="store_true",
+    dest="digest",
+    required=False,
+    default=False,
+    help=(
+        "Only report and summarize the issues that were added, changed or removed"
+        " since the previous run of the job in the snapshot store (requires"
+        " --history-db)"
+    ),
+)
 
 args = parser.parse_args()
 
+# Number of issues reported by default, which used to be one search page
+DEFAULT_MAX_ISSUES = 100
+
+if args.record_path and args.replay_path:
+    parser.error("--record and --replay cannot be used together")
+
+if args.replay_path or args.plan:
+    args.local = True
+
 if (
     args.recipients
     and (
@@ -220,16 +490,1049 @@ if (
 if args.email_from is None:
     args.email_from = args.email_user
 
+if args.trend_weeks and not args.history_db:
+    parser.error("--trend-weeks requires --history-db")
+
+if args.digest and not args.history_db:
+    parser.error("--digest requires --history-db")
+
+if args.history_weeks and args.history_weeks < args.trend_weeks:
+    parser.error("--history-weeks must cover at least --trend-weeks")
+
+if args.job_name is None:
+    args.job_name = args.jql
+
+if min(args.enrich_workers, args.tldr_workers, args.queue_size) < 1:
+    parser.error("--enrich-workers, --tldr-workers and --queue-size must be positive")
+
+sharding = bool(args.shards or args.shard_step)
+if sharding and not args.shard_dir:
+    parser.error("--shards and --shard-step require --shard-dir")
+if args.shards is not None and args.shards < 1:
+    parser.error("--shards must be positive")
+if args.shard_workers < 1:
+    parser.error("--shard-workers must be positive")
+if args.shard_step in (None, "plan") and sharding and not args.shards:
+    parser.error("--shard-step plan requires --shards")
+if args.shard_step == "work" and args.shard_index is None:
+    parser.error("--shard-step work requires --shard-index")
+if args.record_path and sharding and args.shard_step is None:
+    parser.error("--record cannot be used with local shard workers")
+
+if args.max_issues is None:
+    args.max_issues = 0 if sharding else DEFAULT_MAX_ISSUES
+if args.max_issues < 0:
+    parser.error("--max-issues cannot be negative")
+if sharding and args.max_issues:
+    parser.error("--shards and --shard-step report every issue; use --max-issues 0")
+
+if args.deadline_minutes is not None and args.deadline_minutes <= 0:
+    parser.error("--deadline-minutes must be positive")
+
+ai_enabled = bool(args.llm_model_api and args.llm_model_id and args.llm_token)
+email_enabled = bool(args.recipients and not args.local)
+# Shard workers render both reports, since the merge step decides how to deliver
+text_enabled = not email_enabled or args.shard_step == "work"
+
+# Page size of the report query, and of the key-only scans of --plan and the shard
+# planner
+SEARCH_PAGE_SIZE = 100
+SCAN_PAGE_SIZE = 1000
+
+# Instrumentation: wall time and call counts per phase, plus per-request latencies
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MEMORY_TOP_SITES = 5
+phase_times = {}
+phase_calls = {}
+request_latencies = {"jira": [], "llm": []}
+memory_phases = {}
+run_start = datetime.now()
+run_timer = perf_counter()
+run_outcome = "failed"
+metrics_lock = threading.Lock()
+# Run metrics of the local shard workers, which are added to the ones of this run
+worker_metrics = []
+
+# Latency budget: the parts of the report that were degraded to meet the deadline,
+# with the number of issues affected
+LLM_TIMEOUT = 30
+JIRA_TIMEOUT = 30
+LLM_MIN_TIMEOUT = 5
+deadline = (
+    run_timer + args.deadline_minutes * 60 if args.deadline_minutes else None
+)
+degradations = {}
+
+
+def time_left():
+    """Seconds until the deadline, less the delivery reserve, or None without one"""
+    if deadline is None:
+        return None
+    return deadline - perf_counter() - args.deadline_reserve
+
+
+def budget_low(needed):
+    left = time_left()
+    return left is not None and left < needed
+
+
+def degrade(reason, count=1):
+    """Count an issue (or with count=None, the whole report) as degraded"""
+    with metrics_lock:
+        if reason not in degradations:
+            logger.warning(f"Degrading the report to meet the deadline: {reason}")
+        if count is None:
+            degradations[reason] = None
+        else:
+            degradations[reason] = degradations.get(reason, 0) + count
+
+
+def record_phase(phase, start, api=None):
+    """Add the time since start to a phase, and to an API's request latencies"""
+    elapsed = perf_counter() - start
+    with metrics_lock:
+        phase_times[phase] = phase_times.get(phase, 0) + elapsed
+        phase_calls[phase] = phase_calls.get(phase, 0) + 1
+        if api:
+            request_latencies[api].append(elapsed)
+
+
+@contextmanager
+def timed(phase, api=None):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, start, api)
+
+
+# Memory profiling: traced memory at the end of each major phase of the run
+if args.memory_profile or args.memory_budget:
+    import tracemalloc
+
+    tracemalloc.start()
+
+
+def top_allocation_sites():
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        )
+    )
+    return [
+        {"site": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+        for stat in snapshot.statistics("lineno")[:MEMORY_TOP_SITES]
+    ]
+
+
+def check_memory_budget(phase):
+    """Exit with a breakdown of where the memory went if the budget is exceeded"""
+    global run_outcome
+    if not args.memory_budget:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    if peak <= args.memory_budget * 1024 * 1024:
+        return
+    run_outcome = "over_memory_budget"
+    logger.error(
+        f"Traced memory peaked at {peak / 1048576:.1f} MiB during {phase}, over the"
+        f" {args.memory_budget} MiB budget"
+    )
+    for name, values in memory_phases.items():
+        logger.error(f"  {name}: peak {values['peak_bytes'] / 1048576:.1f} MiB")
+    logger.error(f"Top allocation sites during {phase}:")
+    for site in top_allocation_sites():
+        logger.error(f"  {site['bytes'] / 1048576:.1f} MiB in {site['site']}")
+    sys.exit(1)
+
+
+def memory_checkpoint(phase):
+    """Record the traced memory of the phase that just ended and enforce the budget"""
+    if not (args.memory_profile or args.memory_budget):
+        return
+    check_memory_budget(phase)
+    current, peak = tracemalloc.get_traced_memory()
+    memory_phases[phase] = {
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top_sites": top_allocation_sites(),
+    }
+    tracemalloc.reset_peak()
+
+
+def metrics_summary():
+    requests = {}
+    for api, latencies in request_latencies.items():
+        buckets = {
+            str(le): sum(1 for latency in latencies if latency <= le)
+            for le in LATENCY_BUCKETS
+        }
+        buckets["+Inf"] = len(latencies)
+        requests[api] = {
+            "count": len(latencies),
+            "seconds": round(sum(latencies), 6),
+            "max_seconds": round(max(latencies, default=0), 6),
+            "buckets": buckets,
+        }
+    return {
+        "start": run_start.isoformat(timespec="seconds"),
+        "duration": round(perf_counter() - run_timer, 6),
+        "outcome": run_outcome,
+        "phases": {
+            phase: {"seconds": round(seconds, 6), "calls": phase_calls[phase]}
+            for phase, seconds in phase_times.items()
+        },
+        "requests": requests,
+        "memory": memory_phases,
+        "degradations": degradations,
+    }
+
+
+def add_worker_metrics(summary):
+    """Add the phases and requests of the shard workers to the run metrics"""
+    for worker in worker_metrics:
+        for phase, values in worker.get("phases", {}).items():
+            totals = summary["phases"].setdefault(phase, {"seconds": 0, "calls": 0})
+            totals["seconds"] = round(totals["seconds"] + values["seconds"], 6)
+            totals["calls"] += values["calls"]
+        for api, values in worker.get("requests", {}).items():
+            totals = summary["requests"][api]
+            totals["count"] += values["count"]
+            totals["seconds"] = round(totals["seconds"] + values["seconds"], 6)
+            totals["max_seconds"] = max(totals["max_seconds"], values["max_seconds"])
+            for le, count in values["buckets"].items():
+                totals["buckets"][le] += count
+    return summary
+
+
+def prometheus_text(summary):
+    lines = [
+        "# HELP jira_report_run_seconds Wall time of the whole report run",
+        "# TYPE jira_report_run_seconds gauge",
+        f"jira_report_run_seconds {summary['duration']}",
+        "# HELP jira_report_run_success Whether the report run succeeded",
+        "# TYPE jira_report_run_success gauge",
+        f"jira_report_run_success {int(summary['outcome'] == 'success')}",
+        "# HELP jira_report_run_degraded Whether the report was degraded to meet the"
+        " deadline",
+        "# TYPE jira_report_run_degraded gauge",
+        f"jira_report_run_degraded {int(bool(summary['degradations']))}",
+        "# HELP jira_report_phase_seconds Wall time spent in each phase of the run",
+        "# TYPE jira_report_phase_seconds gauge",
+    ]
+    for phase, values in summary["phases"].items():
+        labels = f'{{phase="{phase}"}}'
+        lines.append(f"jira_report_phase_seconds{labels} {values['seconds']}")
+    lines.extend(
+        [
+            "# HELP jira_report_phase_calls Number of times each phase was entered",
+            "# TYPE jira_report_phase_calls gauge",
+        ]
+    )
+    for phase, values in summary["phases"].items():
+        lines.append(f'jira_report_phase_calls{{phase="{phase}"}} {values["calls"]}')
+    lines.extend(
+        [
+            "# HELP jira_report_request_seconds Latency of Jira and LLM API requests",
+            "# TYPE jira_report_request_seconds histogram",
+        ]
+    )
+    for api, values in summary["requests"].items():
+        for le, count in values["buckets"].items():
+            lines.append(
+                f'jira_report_request_seconds_bucket{{api="{api}",le="{le}"}} {count}'
+            )
+        labels = f'{{api="{api}"}}'
+        lines.append(f"jira_report_request_seconds_sum{labels} {values['seconds']}")
+        lines.append(f"jira_report_request_seconds_count{labels} {values['count']}")
+    if summary["memory"]:
+        lines.extend(
+            [
+                "# HELP jira_report_memory_peak_bytes Peak traced memory of each phase",
+                "# TYPE jira_report_memory_peak_bytes gauge",
+            ]
+        )
+        for phase, values in summary["memory"].items():
+            peak = values["peak_bytes"]
+            lines.append(f'jira_report_memory_peak_bytes{{phase="{phase}"}} {peak}')
+    return "\n".join(lines) + "\n"
+
+
+@atexit.register
+def write_metrics():
+    summary = add_worker_metrics(metrics_summary())
+    logger.info(
+        "Phase timings: "
+        + ", ".join(
+            f"{phase} {values['seconds']:.3f}s/{values['calls']}"
+            for phase, values in summary["phases"].items()
+        )
+    )
+    if args.metrics_file:
+        with open(args.metrics_file, "w") as stream:
+            json.dump(summary, stream, indent=2)
+    if args.prometheus_file:
+        with open(args.prometheus_file, "w") as stream:
+            stream.write(prometheus_text(summary))
+
+
+# Record/replay of the HTTP traffic to Jira and the LLM. Both go through requests, so
+# the exchanges are captured at the transport adapter level.
+CASSETTE_HEADERS = ("Content-Type", "Retry-After")
+cassette_lock = threading.Lock()
+
+
+def redact(text):
+    for secret in (args.jira_token, args.llm_token, args.email_password):
+        if secret:
+            text = text.replace(secret, "REDACTED")
+    return text
+
+
+def cassette_key(request):
+    """Match requests by method, path, query and body, but not by server, so that a
+    cassette can be replayed with a different --server"""
+    url = urlsplit(request.url)
+    body = request.body or ""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    # Report links in LLM prompts contain the Jira server URL
+    body = body.replace(args.jira_server, "{jira_server}")
+    return (request.method, f"{url.path}?{url.query}", body)
+
+
+if args.record_path:
+    import gzip
+    from requests.adapters import HTTPAdapter
+
+    cassette = gzip.open(args.record_path, "wt")
+    cassette.write(json.dumps({"version": 1, "recorded": datetime.now().isoformat()}))
+    cassette.write("\n")
+    atexit.register(cassette.close)
+    adapter_send = HTTPAdapter.send
+
+    def recording_send(self, request, **kwargs):
+        start = perf_counter()
+        response = adapter_send(self, request, **kwargs)
+        elapsed = perf_counter() - start
+        method, url, body = cassette_key(request)
+        interaction = {
+            "method": method,
+            "url": redact(url),
+            "request_body": redact(body),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {
+                name: response.headers[name]
+                for name in CASSETTE_HEADERS
+                if name in response.headers
+            },
+            "body": redact(response.content.decode("utf-8", "replace")),
+            "elapsed": round(elapsed, 6),
+        }
+        with cassette_lock:
+            cassette.write(json.dumps(interaction) + "\n")
+        return response
+
+    HTTPAdapter.send = recording_send
+
+if args.replay_path:
+    import gzip
+    from requests import Response, ConnectionError
+    from requests.adapters import HTTPAdapter
+    from requests.structures import CaseInsensitiveDict
+
+    # Identical requests are answered in recorded order; the last answer repeats
+    replay_queues = {}
+    with gzip.open(args.replay_path, "rt") as cassette:
+        next(cassette)
+        for line in cassette:
+            interaction = json.loads(line)
+            key = (
+                interaction["method"],
+                interaction["url"],
+                interaction["request_body"],
+            )
+            replay_queues.setdefault(key, []).append(interaction)
+    logger.info(
+        f"Replaying {sum(map(len, replay_queues.values()))} recorded HTTP exchanges"
+        f" from {args.replay_path}"
+    )
+
+    def replaying_send(self, request, **kwargs):
+        key = cassette_key(request)
+        with cassette_lock:
+            queue = replay_queues.get(key)
+            if not queue:
+                raise ConnectionError(
+                    f"No recorded response for {key[0]} {key[1]}", request=request
+                )
+            interaction = queue.pop(0) if len(queue) > 1 else queue[0]
+        if args.replay_latency:
+            sleep(interaction["elapsed"])
+        response = Response()
+        response.status_code = interaction["status"]
+        response.reason = interaction["reason"]
+        response.headers = CaseInsensitiveDict(interaction["headers"])
+        response._content = interaction["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=interaction["elapsed"])
+        return response
+
+    HTTPAdapter.send = replaying_send
+
+
+# Snapshot store: the processed issues of every run, so that trend sections can be
+# computed locally instead of with historical JQL queries
+HISTORY_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS runs ("
+    " job TEXT NOT NULL, run_time TEXT NOT NULL, issue_count INTEGER NOT NULL,"
+    " PRIMARY KEY (job, run_time))",
+    "CREATE TABLE IF NOT EXISTS issue_snapshots ("
+    " job TEXT NOT NULL, run_time TEXT NOT NULL, issue_key TEXT NOT NULL,"
+    " summary TEXT, owner TEXT, status TEXT, epic TEXT, updated TEXT,"
+    " stale INTEGER NOT NULL, comment_hash TEXT)",
+    "CREATE INDEX IF NOT EXISTS issue_snapshots_job_run_key"
+    " ON issue_snapshots (job, run_time, issue_key)",
+    "CREATE INDEX IF NOT EXISTS issue_snapshots_job_key_status"
+    " ON issue_snapshots (job, issue_key, status)",
+)
+
+
+def history_week(column="run_time"):
+    """SQLite expression for the Monday of the week of a timestamp"""
+    return f"date({column}, '-6 days', 'weekday 1')"
+
+
+def open_history():
+    import sqlite3
+
+    connection = sqlite3.connect(args.history_db, timeout=30)
+    for statement in HISTORY_SCHEMA:
+        connection.execute(statement)
+    # Stores created before the digest mode have no latest comment hashes
+    columns = [
+        row[1] for row in connection.execute("PRAGMA table_info(issue_snapshots)")
+    ]
+    if "comment_hash" not in columns:
+        connection.execute("ALTER TABLE issue_snapshots ADD COLUMN comment_hash TEXT")
+    return connection
+
+
+def comment_hash(text):
+    from hashlib import sha256
+
+    return sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def load_previous_snapshot(connection):
+    """Return the issues of the latest recorded run of the job by key, or None if the
+    job has not run before"""
+    rows = connection.execute(
+        "SELECT issue_key, summary, status, epic, updated, comment_hash"
+        " FROM issue_snapshots WHERE job = ? AND run_time = ("
+        "  SELECT MAX(run_time) FROM runs WHERE job = ?)",
+        (args.job_name, args.job_name),
+    ).fetchall()
+    if not rows:
+        return None
+    return {
+        key: {
+            "summary": summary,
+            "status": status,
+            "epic": epic,
+            "updated": updated,
+            "comment_hash": latest_hash,
+        }
+        for key, summary, status, epic, updated, latest_hash in rows
+    }
+
+
+def describe_change(previous, status, updated, latest_hash):
+    """Return how an issue changed since the previous run, or None if it did not"""
+    if previous is None:
+        return "Added"
+    changes = []
+    if previous["status"] != status:
+        changes.append(f"status {previous['status']} -> {status}")
+    if previous["updated"] != updated:
+        changes.append("updated")
+    if previous["comment_hash"] not in (None, latest_hash):
+        changes.append("latest comment")
+    if not changes:
+        return None
+    return f"Changed {', '.join(changes)}"
+
+
+def record_snapshot(connection, run_time, rows):
+    """Append the processed issues of this run to the snapshot store, in a
+    transaction that the caller commits or rolls back"""
+    # A run of the job in the same second replaces the earlier one
+    connection.execute(
+        "DELETE FROM issue_snapshots WHERE job = ? AND run_time = ?",
+        (args.job_name, run_time),
+    )
+    connection.execute(
+        "INSERT OR REPLACE INTO runs VALUES (?, ?, ?)",
+        (args.job_name, run_time, len(rows)),
+    )
+    connection.executemany(
+        "INSERT INTO issue_snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(args.job_name, run_time, *row) for row in rows],
+    )
+
+
+def prune_snapshots(connection, before):
+    """Drop the runs of the job recorded before the given time"""
+    for table in ("issue_snapshots", "runs"):
+        connection.execute(
+            f"DELETE FROM {table} WHERE job = ? AND run_time < ?",
+            (args.job_name, before),
+        )
+
+
+def snapshot_row(result, owner, epic_number, updated_time, latest_hash):
+    stale = (datetime.now(updated_time.tzinfo) - updated_time).days >= int(
+        args.update_grace_days
+    )
+    return (
+        result["key"],
+        result["fields"]["summary"],
+        owner,
+        result["fields"]["status"]["name"],
+        epic_number,
+        updated_time.isoformat(),
+        int(stale),
+        latest_hash,
+    )
+
+
+def trend_lines(connection, since):
+    """Return the trend section as (heading, lines) pairs"""
+    stale = connection.execute(
+        f"SELECT {history_week()}, issue_count,"
+        " (SELECT SUM(stale) FROM issue_snapshots s"
+        "  WHERE s.job = runs.job AND s.run_time = runs.run_time)"
+        " FROM runs WHERE job = ? AND run_time IN ("
+        "  SELECT MAX(run_time) FROM runs WHERE job = ? AND run_time >= ?"
+        f"  GROUP BY {history_week()})"
+        " ORDER BY run_time",
+        (args.job_name, args.job_name, since),
+    ).fetchall()
+
+    # An issue counts as closed in the week of the first run that saw it closed,
+    # unless it was already closed in the first recorded run of the job
+    closed = {}
+    for week, owner in connection.execute(
+        f"SELECT {history_week('MIN(run_time)')}, owner"
+        " FROM issue_snapshots WHERE job = ? AND status = 'Closed'"
+        " GROUP BY issue_key HAVING MIN(run_time) >= ? AND MIN(run_time) > ("
+        "  SELECT MIN(run_time) FROM runs WHERE job = ?)",
+        (args.job_name, since, args.job_name),
+    ):
+        owners = closed.setdefault(week, {})
+        owners[owner] = owners.get(owner, 0) + 1
+
+    return [
+        (
+            "Stale issues per week",
+            [
+                f"Week of {week}: {count or 0} of {total} not updated in"
+                f" {args.update_grace_days} days"
+                for week, total, count in stale
+            ],
+        ),
+        (
+            "Closed issues per week by owner",
+            [
+                f"Week of {week}: "
+                + ", ".join(
+                    f"{owner} ({count})"
+                    for owner, count in sorted(closed[week].items())
+                )
+                for week in sorted(closed)
+            ]
+            or ["None"],
+        ),
+    ]
+
+
+# Fragment cache: the rendered report fragments of each issue by issue version, so
+# that unchanged issues skip the lookups, AI TL;DR and rendering. The Updated line
+# of the HTML report is left as a marker and highlighted again on every run.
+RENDERER_VERSION = 1
+FRAGMENT_CACHE_DAYS = 30
+UPDATED_MARKER = "\0updated\0"
+FRAGMENT_CACHE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS fragments ("
+    " cache_key TEXT PRIMARY KEY, issue_key TEXT NOT NULL, updated TEXT NOT NULL,"
+    " html TEXT NOT NULL, llm TEXT, text TEXT, epic TEXT, used TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS fragments_issue_key ON fragments (issue_key)",
+)
+fragment_cache_lock = threading.Lock()
+
+
+def open_fragment_cache():
+    import sqlite3
+
+    # Lookups and updates come from different pipeline threads
+    connection = sqlite3.connect(
+        args.fragment_cache, timeout=30, check_same_thread=False
+    )
+    for statement in FRAGMENT_CACHE_SCHEMA:
+        connection.execute(statement)
+    return connection
+
+
+def fragment_cache_key(key, updated, change):
+    """Everything besides the issue version that changes the rendered issue"""
+    return comment_hash(
+        json.dumps(
+            [
+                RENDERER_VERSION,
+                key,
+                updated,
+                str(args.update_grace_days),
+                args.jira_server,
+                args.author_filter,
+                args.llm_model_id if ai_enabled else None,
+                change,
+            ]
+        )
+    )
+
+
+def load_fragments(connection, cache_key):
+    """Return the cached html, llm and text fragments and epic of an issue, or None"""
+    with fragment_cache_lock:
+        row = connection.execute(
+            "SELECT html, llm, text, epic FROM fragments WHERE cache_key = ?",
+            (cache_key,),
+        ).fetchone()
+    return row
+
+
+def store_fragments(connection, rows, used_keys):
+    """Replace the older versions of the rendered issues, mark the reused ones as
+    used and drop the ones not used for FRAGMENT_CACHE_DAYS"""
+    today = run_start.date().isoformat()
+    expired = (run_start - timedelta(days=FRAGMENT_CACHE_DAYS)).date().isoformat()
+    with fragment_cache_lock, connection:
+        connection.executemany(
+            "DELETE FROM fragments WHERE issue_key = ? AND updated != ?",
+            [(row[1], row[2]) for row in rows],
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*row, today) for row in rows],
+        )
+        connection.executemany(
+            "UPDATE fragments SET used = ? WHERE cache_key = ?",
+            [(today, cache_key) for cache_key in used_keys],
+        )
+        connection.execute("DELETE FROM fragments WHERE used < ?", (expired,))
+
+
+# Report pipeline: stages connected by bounded queues, each stage with its own
+# worker threads. A failure in any stage stops the whole pipeline, and the error is
+# re-raised in the main thread.
+PIPELINE_DONE = object()
+pipeline_failed = threading.Event()
+pipeline_errors = []
+
+
+def pipeline_fail(error):
+    pipeline_errors.append(error)
+    pipeline_failed.set()
+
+
+def pipeline_put(stage_queue, item):
+    while not pipeline_failed.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return
+        except Full:
+            pass
+
+
+def pipeline_get(stage_queue):
+    while not pipeline_failed.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except Empty:
+            pass
+    return PIPELINE_DONE
+
+
+def start_producer(producer, outbox):
+    """Start a thread that runs producer(outbox) and then ends the stream"""
+
+    def work():
+        try:
+            producer(outbox)
+        except BaseException as error:
+            pipeline_fail(error)
+        finally:
+            pipeline_put(outbox, PIPELINE_DONE)
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+    return [thread]
+
+
+def start_stage(handler, inbox, outbox, workers):
+    """Start worker threads that pass each item of inbox through handler to outbox;
+    handler returns None to drop an item, and outbox is None for the last stage"""
+    remaining = [workers]
+    remaining_lock = threading.Lock()
+
+    def work():
+        try:
+            while True:
+                item = pipeline_get(inbox)
+                if item is PIPELINE_DONE:
+                    # Let the other workers of the stage see the end of the stream
+                    pipeline_put(inbox, PIPELINE_DONE)
+                    break
+                item = handler(item)
+                if item is not None and outbox is not None:
+                    pipeline_put(outbox, item)
+        except BaseException as error:
+            pipeline_fail(error)
+        finally:
+            with remaining_lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and outbox is not None:
+                pipeline_put(outbox, PIPELINE_DONE)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def wait_for_pipeline(threads):
+    for thread in threads:
+        while thread.is_alive() and not pipeline_failed.is_set():
+            thread.join(0.1)
+    if pipeline_errors:
+        raise pipeline_errors[0]
+
+
+def scan_issues(fields, phase):
+    """Key-only scan of the report query with just the given fields"""
+    issues = []
+    page_token = None
+    try:
+        while True:
+            with timed(phase, api="jira"):
+                page = jira_conn.enhanced_search_issues(
+                    jql_str=args.jql,
+                    nextPageToken=page_token,
+                    maxResults=SCAN_PAGE_SIZE,
+                    fields=fields,
+                    json_result=True,
+                )
+            issues.extend(page.get("issues", []))
+            page_token = page.get("nextPageToken")
+            if not page_token or page.get("isLast", True):
+                break
+    except JIRAError as error:
+        logger.error(f"Jira query error:\n{error}")
+        sys.exit(1)
+    return issues
+
+
+# Sharded runs: a shard plan splits the query into JQL queries that are processed
+# by separate workers, each writing its rendered issues to a partial result in the
+# shard directory, and a merge step renders and delivers one report from them
+SHARD_PLAN_FILE = "shard-plan.json"
+SHARD_RESULT_FORMAT = "shard-{}.json.gz"
+
+
+def shard_jql(clause):
+    """Restrict the report query to a shard, keeping its ORDER BY"""
+    order_by = re.search(r"\bORDER\s+BY\b.*$", args.jql, re.IGNORECASE | re.DOTALL)
+    where = args.jql[: order_by.start()] if order_by else args.jql
+    jql = " AND ".join(f"({part.strip()})" for part in (where, clause) if part.strip())
+    return f"{jql} {order_by.group(0)}" if order_by else jql
+
+
+def shard_clauses_by_key(issues):
+    """Contiguous key ranges of about the same number of issues"""
+    keys = sorted(
+        (key.rsplit("-", 1)[0], int(key.rsplit("-", 1)[1]))
+        for key in (issue["key"] for issue in issues)
+    )
+    size = -(-len(keys) // args.shards)
+    clauses = []
+    for start in range(0, len(keys), size):
+        ranges = {}
+        for project, number in keys[start:start + size]:
+            low, high = ranges.get(project, (number, number))
+            ranges[project] = (min(low, number), max(high, number))
+        clauses.append(
+            " OR ".join(
+                f'(project = "{project}" AND issuekey >= {project}-{low}'
+                f" AND issuekey <= {project}-{high})"
+                for project, (low, high) in ranges.items()
+            )
+        )
+    return clauses
+
+
+def shard_clauses_by_project(issues):
+    """Projects packed into shards of about the same number of issues"""
+    counts = {}
+    for issue in issues:
+        project = issue["key"].rsplit("-", 1)[0]
+        counts[project] = counts.get(project, 0) + 1
+    shards = [[0, []] for _ in range(args.shards)]
+    for project, count in sorted(counts.items(), key=lambda item: -item[1]):
+        shard = min(shards, key=lambda shard: shard[0])
+        shard[0] += count
+        shard[1].append(f'"{project}"')
+    return [f"project in ({', '.join(projects)})" for _, projects in shards if projects]
+
+
+def shard_clauses_by_updated(issues):
+    """Windows of the updated time with about the same number of issues"""
+    from zoneinfo import ZoneInfo
+
+    # JQL dates are in the time zone of the Jira user, to the minute
+    with timed("shard_time_zone", api="jira"):
+        time_zone = ZoneInfo(jira_conn.myself().get("timeZone") or "UTC")
+    times = sorted(
+        datetime.strptime(issue["fields"]["updated"], "%Y-%m-%dT%H:%M:%S.%f%z")
+        for issue in issues
+    )
+    bounds = sorted(
+        {
+            times[n * len(times) // args.shards]
+            .astimezone(time_zone)
+            .strftime("%Y/%m/%d %H:%M")
+            for n in range(1, args.shards)
+        }
+    )
+    edges = [None] + bounds + [None]
+    return [
+        " AND ".join(
+            ([f'updated >= "{low}"'] if low else [])
+            + ([f'updated < "{high}"'] if high else [])
+        )
+        for low, high in zip(edges, edges[1:])
+    ]
+
+
+def write_atomically(path, write, opener=open):
+    """Write a file through a temporary file, so that other nodes sharing the
+    directory never read a partial file"""
+    with opener(f"{path}.tmp", "wt") as stream:
+        write(stream)
+    os.replace(f"{path}.tmp", path)
+
+
+def plan_shards():
+    """Split the query into shards with a key-only scan and write the shard plan"""
+    issues = scan_issues(["updated"], "shard_scan")
+    if not issues:
+        logger.error("Query returned no results!")
+        sys.exit(1)
+    clauses = {
+        "key": shard_clauses_by_key,
+        "project": shard_clauses_by_project,
+        "updated": shard_clauses_by_updated,
+    }[args.shard_by](issues)
+    plan = {
+        "version": 1,
+        "created": datetime.now().isoformat(),
+        "jql": args.jql,
+        "shard_by": args.shard_by,
+        "shards": [shard_jql(clause) for clause in clauses],
+        # The merged report follows the order of the report query
+        "order": [issue["key"] for issue in issues],
+    }
+    os.makedirs(args.shard_dir, exist_ok=True)
+    for name in os.listdir(args.shard_dir):
+        if name.startswith("shard-") and name.endswith((".json.gz", "-metrics.json")):
+            os.remove(os.path.join(args.shard_dir, name))
+    write_atomically(
+        os.path.join(args.shard_dir, SHARD_PLAN_FILE),
+        lambda stream: json.dump(plan, stream, indent=2),
+    )
+    logger.info(
+        f"Split {len(issues)} issues into {len(plan['shards'])} shards by"
+        f" {args.shard_by}"
+    )
+    return plan
+
+
+def load_shard_plan():
+    with open(os.path.join(args.shard_dir, SHARD_PLAN_FILE), "r") as stream:
+        plan = json.load(stream)
+    if plan["jql"] != args.jql:
+        logger.error(f"The shard plan in {args.shard_dir} is for another query")
+        sys.exit(1)
+    return plan
+
+
+def without_options(argv, *options):
+    """Remove options and their values from command line arguments"""
+    remaining = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif not any(
+            arg.startswith(f"{option}=" if option.startswith("--") else option)
+            for option in options
+        ):
+            remaining.append(arg)
+    return remaining
+
+
+def run_shard_workers(plan):
+    """Process every shard in a worker process of this script, at most
+    --shard-workers at a time, and collect their run metrics"""
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    # The workers write their metrics to the shard directory, and this run adds
+    # them to its own
+    worker_args = [
+        sys.executable,
+        os.path.abspath(__file__),
+        *without_options(
+            sys.argv[1:],
+            "-M",
+            "--metrics-file",
+            "-P",
+            "--prometheus-file",
+            "--deadline-minutes",
+        ),
+    ]
+    if deadline is not None:
+        # The workers share the deadline of this run
+        remaining = (deadline - perf_counter()) / 60
+        worker_args.extend(["--deadline-minutes", str(max(remaining, 0.01))])
+
+    def metrics_path(index):
+        return os.path.join(args.shard_dir, f"shard-{index}-metrics.json")
+
+    def run_worker(index):
+        return subprocess.call(
+            worker_args
+            + [
+                "--shard-step",
+                "work",
+                "--shard-index",
+                str(index),
+                "--metrics-file",
+                metrics_path(index),
+            ]
+        )
+
+    with ThreadPoolExecutor(args.shard_workers) as pool:
+        returncodes = list(pool.map(run_worker, range(len(plan["shards"]))))
+
+    for index in range(len(plan["shards"])):
+        try:
+            with open(metrics_path(index), "r") as stream:
+                worker_metrics.append(json.load(stream))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read the metrics of shard {index}: {e}")
+    failed = [str(index) for index, code in enumerate(returncodes) if code]
+    if failed:
+        logger.error(f"Shard workers failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+def write_shard_result(plan, fetched_keys, report_fragments):
+    import gzip
+
+    result = {
+        "version": 1,
+        "plan": plan["created"],
+        "shard": args.shard_index,
+        "keys": fetched_keys,
+        "unchanged_count": unchanged_count,
+        "search_truncated": search_truncated,
+        "degradations": degradations,
+        "snapshot_rows": snapshot_rows,
+        "fragments": report_fragments,
+    }
+    write_atomically(
+        os.path.join(args.shard_dir, SHARD_RESULT_FORMAT.format(args.shard_index)),
+        lambda stream: json.dump(result, stream),
+        opener=gzip.open,
+    )
+
+
+def merge_shards(plan):
+    """Read the partial results of every shard and return them as one, with the
+    issues in query order; issues that moved between shards are kept once"""
+    import gzip
+
+    merged = {
+        "keys": set(),
+        "unchanged_count": 0,
+        "search_truncated": False,
+        "snapshot_rows": {},
+        "fragments": {},
+    }
+    for index in range(len(plan["shards"])):
+        path = os.path.join(args.shard_dir, SHARD_RESULT_FORMAT.format(index))
+        try:
+            with gzip.open(path, "rt") as stream:
+                result = json.load(stream)
+        except FileNotFoundError:
+            logger.error(f"Missing the result of shard {index}: {path}")
+            sys.exit(1)
+        if result["plan"] != plan["created"]:
+            logger.error(f"The result of shard {index} is from another shard plan")
+            sys.exit(1)
+        merged["keys"].update(result["keys"])
+        merged["unchanged_count"] += result["unchanged_count"]
+        merged["search_truncated"] |= result["search_truncated"]
+        for reason, count in result["degradations"].items():
+            if count is None or degradations.get(reason, 0) is None:
+                degradations[reason] = None
+            else:
+                degradations[reason] = degradations.get(reason, 0) + count
+        for row in result["snapshot_rows"]:
+            merged["snapshot_rows"].setdefault(row[0], tuple(row))
+        for fragment in result["fragments"]:
+            merged["fragments"].setdefault(fragment[0], tuple(fragment))
+    order = {key: position for position, key in enumerate(plan["order"])}
+    merged["fragments"] = [
+        merged["fragments"][key]
+        for key in sorted(
+            merged["fragments"], key=lambda key: order.get(key, len(order))
+        )
+    ]
+    merged["snapshot_rows"] = list(merged["snapshot_rows"].values())
+    return merged
+
 
 def send_email(subject, body, sender, user, recipients, password):
+    from smtplib import SMTP_SSL
+    from email.mime.text import MIMEText
+
     msg = MIMEText(body, "html")
     msg["Subject"] = subject
     msg["From"] = sender
     msg["To"] = ", ".join(recipients)
-    smtp_server = SMTP_SSL(args.email_server, args.smtp_port)
-    smtp_server.login(user, password)
-    smtp_server.sendmail(sender, recipients, msg.as_string())
-    smtp_server.quit()
+    with timed("smtp"):
+        smtp_server = SMTP_SSL(args.email_server, args.smtp_port)
+        smtp_server.login(user, password)
+        smtp_server.sendmail(sender, recipients, msg.as_string())
+        smtp_server.quit()
 
 
 def llm_helper(
@@ -239,7 +1542,10 @@ def llm_helper(
     token=args.llm_token,
     header_footer=True,
 ):
-    print("Following the white rabbit...")
+    from requests import post
+
+    # A single write, so that concurrent TL;DR requests do not interleave lines
+    print("Following the white rabbit...\n", end="")
 
     message_header = ""
     message_footer = ""
@@ -253,6 +1559,12 @@ def llm_helper(
 
         message_footer = "\n\n== END AI SUMMARY ==\n\n"
 
+    deadline_reply = (
+        message_header
+        + "AI summary unavailable due to the report deadline.\n"
+        + message_footer
+    )
+
     url = f"{model_api.rstrip('/')}/v1/chat/completions"
 
     headers = {
@@ -271,8 +1583,22 @@ def llm_helper(
 
     retries = 3
     for attempt in range(1, retries + 2):  # 1 to retries+1 inclusive
+        # Requests never run past the deadline
+        timeout = LLM_TIMEOUT
+        left = time_left()
+        if left is not None:
+            if left < LLM_MIN_TIMEOUT:
+                degrade("AI requests cut short")
+                return deadline_reply
+            timeout = min(timeout, left)
         try:
-            response = post(url, headers=headers, json=data, timeout=30, verify=False)
+            request_start = perf_counter()
+            try:
+                response = post(
+                    url, headers=headers, json=data, timeout=timeout, verify=False
+                )
+            finally:
+                request_latencies["llm"].append(perf_counter() - request_start)
             response.raise_for_status()
             response_data = response.json()
 
@@ -290,6 +1616,10 @@ def llm_helper(
                     + message_footer
                 )
             wait_time = 3 * attempt  # Exponential backoff: 3s, 6s, 9s, ...
+            if budget_low(wait_time + LLM_MIN_TIMEOUT):
+                print(f"\nError: {str(e)}")
+                degrade("AI requests cut short")
+                return deadline_reply
             print(
                 f"Request failed (attempt {attempt} of {retries + 1}), "
                 f"retrying in {wait_time} seconds..."
@@ -297,178 +1627,463 @@ def llm_helper(
             sleep(wait_time)
 
 
-logger.info(f"Connecting to Jira server: {args.jira_server}")
+from jira import JIRA, JIRAError  # noqa: E402
 
-jira_conn = JIRA(server=args.jira_server, basic_auth=(args.jira_email, args.jira_token))
-
-# Auto-discover the Epic Link custom field ID
+jira_conn = None
 epic_link_field = None
-try:
-    for field in jira_conn.fields():
-        if field["name"] == "Epic Link":
-            epic_link_field = field["id"]
-            logger.info(f"Discovered Epic Link field: {epic_link_field}")
-            break
-    if epic_link_field is None:
-        logger.warning("Epic Link field not found; epic lookups will be skipped")
-except Exception as e:
-    logger.warning(f"Failed to discover Epic Link field: {e}; epic lookups will be skipped")
-
-logger.info(f"Running Jira query with JQL: {args.jql}")
+# The merge step of a sharded report only reads the results of the shards
+if args.shard_step != "merge":
+    logger.info(f"Connecting to Jira server: {args.jira_server}")
+
+    # With a deadline, no single Jira request may outlast the run, and failed
+    # requests degrade the report instead of being retried with long backoffs
+    jira_options = {}
+    if deadline is not None:
+        jira_options = {
+            "timeout": min(JIRA_TIMEOUT, max(time_left(), LLM_MIN_TIMEOUT)),
+            "max_retries": 0,
+        }
+    with timed("connect", api="jira"):
+        jira_conn = JIRA(
+            server=args.jira_server,
+            basic_auth=(args.jira_email, args.jira_token),
+            **jira_options,
+        )
 
-# debug
-pp = pprint.PrettyPrinter(width=41, compact=True)
-# pp.pprint(jira_conn.search_issues(jql_str=args.jql,json_result=True,maxResults=30))
+    # Auto-discover the Epic Link custom field ID
+    try:
+        with timed("fields", api="jira"):
+            fields = jira_conn.fields()
+        for field in fields:
+            if field["name"] == "Epic Link":
+                epic_link_field = field["id"]
+                logger.info(f"Discovered Epic Link field: {epic_link_field}")
+                break
+        if epic_link_field is None:
+            logger.warning("Epic Link field not found; epic lookups will be skipped")
+    except Exception as e:
+        logger.warning(
+            f"Failed to discover Epic Link field: {e}; epic lookups will be skipped"
+        )
 
-issues = []
-
-# Build the array of issues from the JQL query
-try:
-    issues.append(
-        jira_conn.search_issues(
-            jql_str=args.jql,
-            json_result=True,
-            maxResults=100,
-            fields=[
-                "issuetype",
-                "parent",
-                "comment",
-                "assignee",
-                "creator",
-                "status",
-                "updated",
-                "summary",
-                "status",
-            ] + ([epic_link_field] if epic_link_field else []),
+memory_checkpoint("setup")
+
+if args.plan:
+    # Sizes assumed for the content that the plan does not fetch
+    PLAN_COMMENT_CHARS = 2000
+    PLAN_LATEST_COMMENT_CHARS = 400
+    PLAN_TLDR_CHARS = 200
+    PLAN_SUMMARY_CHARS = 4000
+    PLAN_ISSUE_MARKUP_CHARS = 450
+    PLAN_TLDR_PROMPT_CHARS = 150
+    PLAN_SUMMARY_PROMPT_CHARS = 1400
+
+    logger.info(f"Planning Jira query with JQL: {args.jql}")
+    try:
+        with timed("plan_count", api="jira"):
+            approximate_count = jira_conn.approximate_issue_count(args.jql)
+    except Exception as e:
+        logger.warning(f"Approximate issue count unavailable: {e}")
+        approximate_count = None
+
+    # Key-only scan with just the fields that decide the epic and parent lookups
+    plan_issues = scan_issues(
+        ["summary", "issuetype", "parent"]
+        + ([epic_link_field] if epic_link_field else []),
+        "plan_scan",
+    )
+    issue_total = len(plan_issues)
+    reported = plan_issues[: args.max_issues] if args.max_issues else plan_issues
+    epics = set()
+    parents = set()
+    for result in reported:
+        if epic_link_field and result["fields"].get(epic_link_field):
+            epics.add(result["fields"][epic_link_field])
+        elif result["fields"]["issuetype"]["subtask"]:
+            parents.add(result["fields"]["parent"]["key"])
+
+    # Each distinct epic and parent is looked up once
+    lookups = len(epics) + len(parents)
+    search_pages = max(1, -(-len(reported) // SEARCH_PAGE_SIZE))
+    jira_requests = 3 + search_pages + lookups
+    llm_calls = len(reported) + 1 if ai_enabled else 0
+
+    issue_chars = [
+        PLAN_ISSUE_MARKUP_CHARS
+        + len(result["fields"]["summary"])
+        + 2 * len(args.jira_server)
+        + PLAN_LATEST_COMMENT_CHARS
+        + (PLAN_TLDR_CHARS if ai_enabled else 0)
+        for result in reported
+    ]
+    tldr_prompt_chars = len(reported) * (PLAN_TLDR_PROMPT_CHARS + PLAN_COMMENT_CHARS)
+    summary_prompt_chars = (
+        PLAN_SUMMARY_PROMPT_CHARS
+        + sum(issue_chars)
+        + len(reported) * PLAN_COMMENT_CHARS
+    )
+    email_chars = sum(issue_chars) + (PLAN_SUMMARY_CHARS if ai_enabled else 0)
+
+    print(f"Plan for JQL: {args.jql}")
+    print(
+        f"  Issues: {issue_total}"
+        + (
+            f" (approximate count {approximate_count})"
+            if approximate_count is not None
+            else ""
         )
     )
-except JIRAError as error:
-    logger.error(f"Jira query error:\n{error}")
-    sys.exit(1)
+    if len(reported) < issue_total:
+        print(f"  Issues reported: {len(reported)} (limited by --max-issues)")
+    print(f"  Distinct epics: {len(epics)}, distinct subtask parents: {len(parents)}")
+    print(
+        f"  Jira requests: {jira_requests} ({search_pages} search page(s),"
+        f" {lookups} epic/parent lookups, 3 for connecting and field discovery)"
+    )
+    if ai_enabled:
+        print(
+            f"  LLM calls: {llm_calls} ({len(reported)} TL;DR + 1 summary),"
+            f" ~{(tldr_prompt_chars + summary_prompt_chars) // 4} prompt tokens"
+            f" (assuming ~{PLAN_COMMENT_CHARS} characters of comments per issue)"
+        )
+    else:
+        print("  LLM calls: 0 (AI summaries disabled)")
+    print(f"  Expected email size: ~{email_chars // 1024} KiB")
+
+    if args.plan_max_issues is not None and issue_total > args.plan_max_issues:
+        logger.error(
+            f"Query matches {issue_total} issues, over the limit of"
+            f" {args.plan_max_issues}"
+        )
+        sys.exit(1)
+    run_outcome = "success"
+    sys.exit(0)
+
+shard_plan = None
+if sharding and args.shard_step in (None, "plan"):
+    with timed("shard_plan"):
+        shard_plan = plan_shards()
+    if args.shard_step == "plan":
+        run_outcome = "success"
+        sys.exit(0)
+    with timed("shard_workers"):
+        run_shard_workers(shard_plan)
+elif sharding:
+    shard_plan = load_shard_plan()
+
+if args.shard_step == "work":
+    if not 0 <= args.shard_index < len(shard_plan["shards"]):
+        logger.error(f"The shard plan has {len(shard_plan['shards'])} shards")
+        sys.exit(1)
+    args.jql = shard_plan["shards"][args.shard_index]
+    logger.info(f"Processing shard {args.shard_index}")
+
+if not sharding or args.shard_step == "work":
+    logger.info(f"Running Jira query with JQL: {args.jql}")
 
 # debug
-# pp.pprint(issues)
-# exit()
-
-report_list = []
-
-issue_count = issues[0].get("total", len(issues[0].get("issues", [])))
-if issue_count > 0:
-    logger.info(f"Issue count: {issue_count}")
-    for issue in issues:
-        for result in issue["issues"]:
-            result_dict = {}
-            subtask = None
-            epic_number = None
-
-            if result["fields"]["assignee"] is None:
-                owner = "NO OWNER"
-            else:
-                owner = result["fields"]["assignee"]["displayName"]
-
-            all_comments = []
-            if len(result["fields"]["comment"]["comments"]) > 0:
-                for comment in result["fields"]["comment"]["comments"]:
-                    if args.author_filter in comment["author"]["displayName"]:
-                        continue
-                    all_comments.append(comment["body"])
-                comment_number = -1
-                try:
-                    while (
-                        args.author_filter
-                        in result["fields"]["comment"]["comments"][comment_number][
-                            "author"
-                        ]["displayName"]
-                    ):
-                        comment_number -= 1
-                        # debug
-                        # print(f'Skipped comment: {result["fields"]["comment"]["comments"][comment_number]["body"]}')
-                    latest_comment = result["fields"]["comment"]["comments"][
-                        comment_number
-                    ]["body"]
-                except IndexError:
-                    latest_comment = "None (filtered)"
-            else:
-                latest_comment = "None"
-            updated_time = datetime.strptime(
-                result["fields"]["updated"], "%Y-%m-%dT%H:%M:%S.%f%z"
-            )
+# import pprint
+# pp = pprint.PrettyPrinter(width=41, compact=True)
+# pp.pprint(jira_conn.search_issues(jql_str=args.jql,json_result=True,maxResults=30))
 
-            if epic_link_field and result["fields"].get(epic_link_field):
-                # Get the epic name based on the epic ID
-                epic_jql = f"issue = {result['fields'][epic_link_field]}"
-                try:
-                    epic_search = jira_conn.search_issues(
-                        jql_str=epic_jql,
-                        json_result=True,
-                        maxResults=1,
-                        fields=["summary"],
-                    )
-                except JIRAError as error:
-                    logger.error(f"Jira query error:\n{error}")
-                    sys.exit(1)
-                epic_number = f"{result['fields'][epic_link_field]}"
-                epic_summary = f"{epic_search['issues'][0]['fields']['summary']}"
-                epic = f"{epic_number} - {epic_summary}"
-            elif result["fields"]["issuetype"]["subtask"]:
-                # Subtasks do not return epic IDs, so get it from the parent
-                subtask_jql = f"issue = {result['fields']['parent']['key']}"
-                try:
-                    epic_search = jira_conn.search_issues(
-                        jql_str=subtask_jql,
-                        json_result=True,
-                        maxResults=1,
-                        fields=["summary"] + ([epic_link_field] if epic_link_field else []),
-                    )
-                except JIRAError as error:
-                    logger.error(f"Jira query error:\n{error}")
-                    sys.exit(1)
-                epic_number = (
-                    f"{epic_search['issues'][0]['fields'].get(epic_link_field)}"
-                    if epic_link_field else "None"
+SEARCH_FIELDS = [
+    "issuetype",
+    "parent",
+    "comment",
+    "assignee",
+    "creator",
+    "status",
+    "updated",
+    "summary",
+]
+
+snapshot_rows = []
+history = None
+previous_issues = None
+unchanged_count = 0
+if args.history_db:
+    try:
+        with timed("history"):
+            history = open_history()
+            if args.digest:
+                previous_issues = load_previous_snapshot(history)
+    except Exception as e:
+        logger.warning(f"Failed to open the snapshot store {args.history_db}: {e}")
+    if args.digest and previous_issues is None:
+        logger.info("No previous run of this job found; reporting every issue")
+
+fragment_cache = None
+fragment_cache_hits = []
+new_fragments = []
+# The merge step of a sharded report renders no issues
+if args.fragment_cache and (not sharding or args.shard_step == "work"):
+    try:
+        with timed("fragment_cache"):
+            fragment_cache = open_fragment_cache()
+    except Exception as e:
+        logger.warning(f"Failed to open the fragment cache {args.fragment_cache}: {e}")
+
+issue_count = 0
+fetched_keys = []
+search_truncated = False
+search_limited = False
+# Key and rendered HTML, LLM report and text report fragments of each issue by query
+# order
+fragments = {}
+lookup_lock = threading.Lock()
+lookup_cache = {}
+
+
+def fetch_issues(outbox):
+    """Pipeline producer: page through the report query"""
+    global issue_count, search_truncated, search_limited
+    page_token = None
+    while not pipeline_failed.is_set():
+        page_size = SEARCH_PAGE_SIZE
+        if args.max_issues:
+            page_size = min(page_size, args.max_issues - issue_count)
+        try:
+            with timed("search", api="jira"):
+                page = jira_conn.enhanced_search_issues(
+                    jql_str=args.jql,
+                    nextPageToken=page_token,
+                    maxResults=page_size,
+                    fields=SEARCH_FIELDS
+                    + ([epic_link_field] if epic_link_field else []),
+                    json_result=True,
+                )
+        except Exception as error:
+            # Connection errors and timeouts are raised by requests, not as JIRAError
+            logger.error(f"Jira query error:\n{error}")
+            if deadline is None or issue_count == 0:
+                sys.exit(1)
+            # With a deadline, a failed later page truncates the report instead
+            search_truncated = True
+            degrade(f"Search stopped after the first {issue_count} issues", None)
+            break
+        for result in page.get("issues", []):
+            pipeline_put(outbox, {"index": issue_count, "result": result})
+            issue_count += 1
+            if args.shard_step == "work":
+                fetched_keys.append(result["key"])
+        page_token = page.get("nextPageToken")
+        if not page_token or page.get("isLast", True):
+            break
+        if args.max_issues and issue_count >= args.max_issues:
+            logger.info(f"Reporting the first {issue_count} issues (--max-issues)")
+            search_limited = True
+            break
+        if budget_low(0):
+            search_truncated = True
+            degrade(f"Search stopped after the first {issue_count} issues", None)
+            break
+    # A shard may be empty if the issues moved since the shard plan
+    if issue_count == 0 and args.shard_step != "work":
+        logger.error("Query returned no results!")
+        sys.exit(1)
+
+
+def filter_comments(item):
+    """Pipeline stage: pick the comments to report, and drop unchanged issues in
+    digest mode"""
+    global unchanged_count
+    result = item["result"]
+
+    if result["fields"]["assignee"] is None:
+        item["owner"] = "NO OWNER"
+    else:
+        item["owner"] = result["fields"]["assignee"]["displayName"]
+
+    all_comments = []
+    if len(result["fields"]["comment"]["comments"]) > 0:
+        for comment in result["fields"]["comment"]["comments"]:
+            if args.author_filter in comment["author"]["displayName"]:
+                continue
+            all_comments.append(comment["body"])
+        comment_number = -1
+        try:
+            while (
+                args.author_filter
+                in result["fields"]["comment"]["comments"][comment_number]["author"][
+                    "displayName"
+                ]
+            ):
+                comment_number -= 1
+                # debug
+                # print(f'Skipped comment: {result["fields"]["comment"]["comments"][comment_number]["body"]}')
+            latest_comment = result["fields"]["comment"]["comments"][comment_number][
+                "body"
+            ]
+        except IndexError:
+            latest_comment = "None (filtered)"
+    else:
+        latest_comment = "None"
+    # The full comment history is only kept for the AI summaries
+    item["all_comments"] = "\n".join(all_comments) if ai_enabled else None
+    item["latest_comment"] = latest_comment
+    item["updated_time"] = datetime.strptime(
+        result["fields"]["updated"], "%Y-%m-%dT%H:%M:%S.%f%z"
+    )
+    item["latest_hash"] = comment_hash(latest_comment) if args.history_db else None
+
+    item["change"] = None
+    if previous_issues is not None:
+        previous = previous_issues.pop(result["key"], None)
+        item["change"] = describe_change(
+            previous,
+            result["fields"]["status"]["name"],
+            item["updated_time"].isoformat(),
+            item["latest_hash"],
+        )
+        if item["change"] is None:
+            # Unchanged issues are only recorded, without lookups or summaries
+            unchanged_count += 1
+            snapshot_rows.append(
+                snapshot_row(
+                    result,
+                    item["owner"],
+                    previous["epic"],
+                    item["updated_time"],
+                    item["latest_hash"],
                 )
-                epic_summary = f"{epic_search['issues'][0]['fields']['summary']}"
-                epic = f"{epic_number} - {epic_summary}"
-                subtask = f"This is a subtask of {result['fields']['parent']['key']}"
-            else:
-                epic = result["fields"].get(epic_link_field) if epic_link_field else None
-
-            result_dict["Issue"] = f"{result['key']} - {result['fields']['summary']}"
-            result_dict["Link"] = f"{args.jira_server}/browse/{result['key']}"
-
-            if subtask is not None:
-                result_dict["Sub-Task"] = subtask
-            result_dict["Owner"] = owner
-            result_dict["Epic"] = epic
-            if epic_number:
-                result_dict["Epic Link"] = f"{args.jira_server}/browse/{epic_number}"
-            result_dict["Status"] = result["fields"]["status"]["name"]
-            result_dict["Updated"] = datetime.strftime(
-                updated_time, "%a %d %b %Y, %I:%M%p"
             )
-            result_dict["All Comments"] = "\n".join(all_comments)
-            if args.llm_model_api and args.llm_model_id and args.llm_token:
-                result_dict["AI TL;DR"] = llm_helper(
-                    query = (
-                        "Summarize the below in one sentence. If there isn't enough "
-                        "content to summarize, just say 'No summary available'. Here "
-                        f"is the content:\n{result_dict['All Comments']}"
-                    ),
-                    header_footer = False,
+            return None
+
+    item["cache_key"] = None
+    item["cached"] = None
+    item["cacheable"] = True
+    if fragment_cache is not None:
+        item["cache_key"] = fragment_cache_key(
+            result["key"], item["updated_time"].isoformat(), item["change"]
+        )
+        with timed("fragment_cache"):
+            cached = load_fragments(fragment_cache, item["cache_key"])
+        # Fragments cached by an email run have no text report
+        if cached is not None and (cached[2] is not None or not text_enabled):
+            item["cached"] = cached
+            fragment_cache_hits.append(item["cache_key"])
+    return item
+
+
+def lookup_issue(key, fields):
+    """Search for a single issue; concurrent and repeated lookups of the same issue
+    share one request"""
+    with lookup_lock:
+        entry = lookup_cache.get((key, tuple(fields)))
+        first = entry is None
+        if first:
+            entry = lookup_cache[(key, tuple(fields))] = {"done": threading.Event()}
+    if first:
+        try:
+            with timed("epic_lookup", api="jira"):
+                entry["result"] = jira_conn.search_issues(
+                    jql_str=f"issue = {key}",
+                    json_result=True,
+                    maxResults=1,
+                    fields=list(fields),
                 )
-            result_dict["Latest Update"] = latest_comment
-
-            report_list.append(result_dict)
-
-else:
-    logger.error("Query returned no results!")
-    sys.exit(1)
+        except Exception as error:
+            # Connection errors and timeouts are raised by requests, not as JIRAError
+            entry["error"] = error
+        finally:
+            entry["done"].set()
+    else:
+        entry["done"].wait()
+    if "error" in entry:
+        logger.error(f"Jira query error:\n{entry['error']}")
+        if deadline is not None:
+            # With a deadline, a failed lookup degrades the issue instead of the run
+            return None
+        sys.exit(1)
+    return entry["result"]
+
+
+def enrich_issue(item):
+    """Pipeline stage: look up the epic of the issue, or of its parent for subtasks"""
+    if item["cached"] is not None:
+        return item
+    result = item["result"]
+    item["subtask"] = None
+    item["epic_number"] = None
+    skip_lookup = budget_low(LLM_MIN_TIMEOUT)
+
+    if epic_link_field and result["fields"].get(epic_link_field):
+        # Get the epic name based on the epic ID
+        item["epic_number"] = f"{result['fields'][epic_link_field]}"
+        epic_search = None
+        if skip_lookup:
+            degrade("Issues without epic lookup")
+            item["cacheable"] = False
+        else:
+            epic_search = lookup_issue(item["epic_number"], ["summary"])
+            if epic_search is None:
+                degrade("Failed epic lookups")
+                item["cacheable"] = False
+        if epic_search is None:
+            item["epic"] = f"{item['epic_number']} (epic summary unavailable)"
+        else:
+            epic_summary = f"{epic_search['issues'][0]['fields']['summary']}"
+            item["epic"] = f"{item['epic_number']} - {epic_summary}"
+    elif result["fields"]["issuetype"]["subtask"]:
+        # Subtasks do not return epic IDs, so get it from the parent
+        parent_key = result["fields"]["parent"]["key"]
+        item["subtask"] = f"This is a subtask of {parent_key}"
+        epic_search = None
+        if skip_lookup:
+            degrade("Issues without epic lookup")
+            item["cacheable"] = False
+        else:
+            epic_search = lookup_issue(
+                parent_key,
+                ["summary"] + ([epic_link_field] if epic_link_field else []),
+            )
+            if epic_search is None:
+                degrade("Failed epic lookups")
+                item["cacheable"] = False
+        if epic_search is None:
+            item["epic"] = f"Epic of {parent_key} unavailable"
+        else:
+            item["epic_number"] = (
+                f"{epic_search['issues'][0]['fields'].get(epic_link_field)}"
+                if epic_link_field else "None"
+            )
+            epic_summary = f"{epic_search['issues'][0]['fields']['summary']}"
+            item["epic"] = f"{item['epic_number']} - {epic_summary}"
+    else:
+        item["epic"] = (
+            result["fields"].get(epic_link_field) if epic_link_field else None
+        )
+    return item
+
+
+def summarize_issue(item):
+    """Pipeline stage: AI TL;DR of the comment history"""
+    if item["cached"] is not None:
+        return item
+    # Leave time for one TL;DR request and the AI summary
+    if budget_low(2 * LLM_TIMEOUT):
+        degrade("Issues without AI TL;DR")
+        item["tldr"] = "Skipped to meet the report deadline"
+        item["cacheable"] = False
+        return item
+    with timed("llm_tldr"):
+        item["tldr"] = llm_helper(
+            query = (
+                "Summarize the below in one sentence. If there isn't "
+                "enough content to summarize, just say 'No summary "
+                "available'. Here is the content:\n"
+                f"{item['all_comments']}"
+            ),
+            header_footer = False,
+        )
+    if "AI summary unavailable" in item["tldr"]:
+        item["cacheable"] = False
+    return item
 
-# Always generate the html report so that we can use it for the llm
-html_report = [f"Issue count: {issue_count}<br><br>\n"]
 
-for item in report_list:
-    html_report.append("<hr>\n")
+def render_html_item(item):
+    html_report = ["<hr>\n"]
+    epic_link = None
 
     for key, value in item.items():
         if "Link" in key:
@@ -487,53 +2102,298 @@ for item in report_list:
                         f"<b>{key}</b>: <a href='{link}'>{value}</a><br>"
                     )
                 elif "Epic" in key:
-                    if value:
+                    if value and epic_link:
                         html_report.append(
                             f"<b>{key}</b>: <a href='{epic_link}'>{value}</a><br>"
                         )
+                    elif value:
+                        # Epics that could not be looked up before the deadline
+                        html_report.append(f"<b>{key}</b>: {value}<br>")
                     else:
                         html_report.append(
                             f"<b>{key}</b>: <span style='color:red'>{value}</span><br>"
                         )
                 elif "Updated" in key:
-                    updated_datetime = datetime.strptime(
-                        value, "%a %d %b %Y, %I:%M%p"
-                    )
-                    delta = datetime.now() - updated_datetime
-                    if delta.days >= int(args.update_grace_days):
-                        html_report.append(
-                            f"<b>{key}</b>: <span style='color:red'>{value}</span><br>"
-                        )
-                    else:
-                        html_report.append(f"<b>{key}</b>: {value}<br>")
+                    # Filled in by render_updated_html
+                    html_report.append(UPDATED_MARKER)
                 else:
                     html_report.append(f"<b>{key}</b>: {value}<br>\n")
             else:
                 html_report.append(f"<b>{key}</b>: <pre>{value}</pre><br>\n")
     html_report.append("\n\n")
+    return " ".join(html_report)
+
+
+def render_updated_html(value):
+    updated_datetime = datetime.strptime(value, "%a %d %b %Y, %I:%M%p")
+    delta = datetime.now() - updated_datetime
+    if delta.days >= int(args.update_grace_days):
+        return f"<b>Updated</b>: <span style='color:red'>{value}</span><br>"
+    return f"<b>Updated</b>: {value}<br>"
+
+
+def render_text_item(item, comments=False):
+    """Render an issue for the text report, or with comments=True for the LLM"""
+    report = ["==========\n"]
+    for key, value in item.items():
+        if "All Comments" in key and not comments:
+            continue
+        if "Link" not in key:
+            report.append(f"{key}: {value}\n")
+        elif "Epic" in key and item.get("Epic") and "subtask" not in str(item["Epic"]):
+            report.append(f"({value})\n")
+        elif "Epic" not in key:
+            report.append(f"({value})\n")
+    report.append("\n\n")
+    return " ".join(report)
+
+
+def render_fragments(item, updated):
+    """Render the HTML, LLM report and text report fragments of an issue"""
+    result = item["result"]
+    result_dict = {}
+    result_dict["Issue"] = f"{result['key']} - {result['fields']['summary']}"
+    result_dict["Link"] = f"{args.jira_server}/browse/{result['key']}"
+    if item["change"] is not None:
+        result_dict["Change"] = item["change"]
+    if item["subtask"] is not None:
+        result_dict["Sub-Task"] = item["subtask"]
+    result_dict["Owner"] = item["owner"]
+    result_dict["Epic"] = item["epic"]
+    if item["epic_number"]:
+        result_dict["Epic Link"] = f"{args.jira_server}/browse/{item['epic_number']}"
+    result_dict["Status"] = result["fields"]["status"]["name"]
+    result_dict["Updated"] = updated
+    if ai_enabled:
+        result_dict["All Comments"] = item["all_comments"]
+        result_dict["AI TL;DR"] = item["tldr"]
+    result_dict["Latest Update"] = item["latest_comment"]
+
+    with timed("render_html"):
+        html_fragment = render_html_item(result_dict)
+    llm_fragment = render_text_item(result_dict, comments=True) if ai_enabled else None
+    text_fragment = None
+    if text_enabled:
+        with timed("render_text"):
+            text_fragment = render_text_item(result_dict)
+    return html_fragment, llm_fragment, text_fragment
+
+
+def render_issue(item):
+    """Last pipeline stage: render the issue, or reuse its cached fragments, and
+    record it in the snapshot store"""
+    result = item["result"]
+    updated = datetime.strftime(item["updated_time"], "%a %d %b %Y, %I:%M%p")
+    if item["cached"] is not None:
+        html_fragment, llm_fragment, text_fragment, epic_number = item["cached"]
+    else:
+        epic_number = item["epic_number"]
+        html_fragment, llm_fragment, text_fragment = render_fragments(item, updated)
+        # Degraded issues are rendered again on the next run
+        if item["cache_key"] is not None and item["cacheable"]:
+            new_fragments.append(
+                (
+                    item["cache_key"],
+                    result["key"],
+                    item["updated_time"].isoformat(),
+                    html_fragment,
+                    llm_fragment,
+                    text_fragment,
+                    epic_number,
+                )
+            )
+
+    if args.history_db:
+        snapshot_rows.append(
+            snapshot_row(
+                result,
+                item["owner"],
+                epic_number,
+                item["updated_time"],
+                item["latest_hash"],
+            )
+        )
+
+    # Stale highlighting depends on the time of the run
+    fragments[item["index"]] = (
+        result["key"],
+        html_fragment.replace(UPDATED_MARKER, render_updated_html(updated)),
+        llm_fragment,
+        text_fragment,
+    )
+    check_memory_budget("process")
+
+
+# Issues of the first page are enriched, summarized and rendered while the later
+# pages are still being fetched. Comment filtering and rendering are CPU-bound, so
+# they run in a single thread each.
+if sharding and args.shard_step != "work":
+    with timed("shard_merge"):
+        merged = merge_shards(shard_plan)
+    issue_count = len(merged["keys"])
+    if issue_count == 0:
+        logger.error("Query returned no results!")
+        sys.exit(1)
+    unchanged_count = merged["unchanged_count"]
+    search_truncated = merged["search_truncated"]
+    snapshot_rows = merged["snapshot_rows"]
+    report_fragments = merged["fragments"]
+    if previous_issues is not None:
+        for key in merged["keys"]:
+            previous_issues.pop(key, None)
+    del merged
+else:
+    filter_queue = Queue(args.queue_size)
+    enrich_queue = Queue(args.queue_size)
+    summarize_queue = Queue(args.queue_size)
+    render_queue = Queue(args.queue_size)
+    with timed("pipeline"):
+        pipeline_threads = start_producer(fetch_issues, filter_queue)
+        pipeline_threads += start_stage(
+            filter_comments, filter_queue, enrich_queue, 1
+        )
+        if ai_enabled:
+            pipeline_threads += start_stage(
+                enrich_issue, enrich_queue, summarize_queue, args.enrich_workers
+            )
+            pipeline_threads += start_stage(
+                summarize_issue, summarize_queue, render_queue, args.tldr_workers
+            )
+        else:
+            pipeline_threads += start_stage(
+                enrich_issue, enrich_queue, render_queue, args.enrich_workers
+            )
+        pipeline_threads += start_stage(render_issue, render_queue, None, 1)
+        wait_for_pipeline(pipeline_threads)
+    report_fragments = [fragments[index] for index in sorted(fragments)]
+fragments.clear()
+lookup_cache.clear()
+
+if fragment_cache is not None:
+    logger.info(
+        f"Fragment cache: {len(fragment_cache_hits)} issues reused,"
+        f" {len(new_fragments)} rendered"
+    )
+    try:
+        with timed("fragment_cache"):
+            store_fragments(fragment_cache, new_fragments, fragment_cache_hits)
+            fragment_cache.close()
+    except Exception as e:
+        logger.warning(
+            f"Failed to update the fragment cache {args.fragment_cache}: {e}"
+        )
+    del new_fragments, fragment_cache_hits
+
+# Tell readers how many issues matched when --max-issues left some out
+issue_count_text = f"{issue_count}"
+if search_limited:
+    try:
+        with timed("count", api="jira"):
+            issue_total = jira_conn.approximate_issue_count(args.jql)
+        if issue_total > issue_count:
+            issue_count_text = f"{issue_count} of {issue_total}"
+    except Exception as e:
+        logger.warning(f"Approximate issue count unavailable: {e}")
+
+logger.info(f"Issue count: {issue_count_text}")
+memory_checkpoint("process")
+
+if args.shard_step == "work":
+    write_shard_result(shard_plan, fetched_keys, report_fragments)
+    logger.info(f"Wrote the result of shard {args.shard_index} to {args.shard_dir}")
+    run_outcome = "success"
+    sys.exit(0)
+
+report_sections = []
+if degradations:
+    report_sections.append(
+        (
+            "Degraded to meet the deadline",
+            [
+                reason if count is None else f"{reason}: {count}"
+                for reason, count in degradations.items()
+            ],
+        )
+    )
+if previous_issues is not None and (search_truncated or search_limited):
+    # Issues on the pages that were not fetched are neither changed nor removed
+    report_sections.append(
+        (
+            "Changes since the last report",
+            [f"{len(report_fragments)} added or changed, {unchanged_count} unchanged"],
+        )
+    )
+elif previous_issues is not None:
+    report_sections.append(
+        (
+            "Changes since the last report",
+            [
+                f"{len(report_fragments)} added or changed, {unchanged_count}"
+                f" unchanged, {len(previous_issues)} removed"
+            ]
+            + [
+                f"Removed: {key} - {previous['summary']}"
+                for key, previous in previous_issues.items()
+            ],
+        )
+    )
+if history is not None and search_truncated:
+    # A partial run would show up as removed issues in the next digest
+    logger.warning("Search stopped early; not recording this run in the snapshot store")
+    history.close()
+    history = None
+elif history is not None and args.trend_weeks:
+    # The trends include this run, which is only committed once the report has been
+    # delivered, so that a failed run is reported again by the next digest. The
+    # rows are rolled back right away to not lock the store shared by other jobs.
+    try:
+        with timed("history"):
+            record_snapshot(
+                history, run_start.isoformat(timespec="seconds"), snapshot_rows
+            )
+            since = run_start - timedelta(weeks=args.trend_weeks)
+            report_sections.extend(
+                trend_lines(history, since.isoformat(timespec="seconds"))
+            )
+            history.rollback()
+    except Exception as e:
+        history.rollback()
+        logger.warning(f"Failed to read the snapshot store {args.history_db}: {e}")
+
+# Always generate the html report so that we can use it for the llm
+render_start = perf_counter()
+html_report = [f"Issue count: {issue_count_text}<br><br>\n"]
+for heading, lines in report_sections:
+    html_report.append(f"<b>{heading}</b>:<br>\n")
+    html_report.extend(f"{line}<br>\n" for line in lines)
+    html_report.append("<br>\n")
+html_report.extend(html_fragment for _, html_fragment, _, _ in report_fragments)
 
 html_message = " ".join(html_report)
+del html_report
+record_phase("render_html", render_start)
+memory_checkpoint("render_html")
 
 
 ## LLM Playground
 llm_summary = ""
-if args.llm_model_api and args.llm_model_id and args.llm_token:
+if ai_enabled and report_fragments and budget_low(LLM_MIN_TIMEOUT):
+    degrade("AI summary skipped", None)
+    llm_summary = "AI summary skipped to meet the report deadline."
+elif ai_enabled and report_fragments:
 
-    llm_report = [f"Issue count: {issue_count}\n\n"]
+    llm_report = [f"Issue count: {issue_count_text}\n\n"]
+    for heading, lines in report_sections:
+        llm_report.append(f"{heading}:\n")
+        llm_report.extend(f"  {line}\n" for line in lines)
+        llm_report.append("\n")
 
-    for item in report_list:
-        llm_report.append("==========\n")
-        for key, value in item.items():
-            if "Link" not in key:
-                llm_report.append(f"{key}: {value}\n")
-            elif "Epic" in key and item.get("Epic") and "subtask" not in str(item["Epic"]):
-                llm_report.append(f"({value})\n")
-            elif "Epic" not in key:
-                llm_report.append(f"({value})\n")
-        llm_report.append("\n\n")
+    llm_report.extend(llm_fragment for _, _, llm_fragment, _ in report_fragments)
 
     llm_report_message = " ".join(llm_report)
+    del llm_report
 
+    llm_start = perf_counter()
     llm_summary = llm_helper(
         query = (
             "In a section titled 'Priority Attention Needed', note each issue that "
@@ -567,8 +2427,10 @@ if args.llm_model_api and args.llm_model_id and args.llm_token:
         model_id=args.llm_model_id,
         token=args.llm_token,
     )
+    record_phase("llm_summary", llm_start)
+    memory_checkpoint("llm_summary")
 
-if args.recipients and not args.local:
+if email_enabled:
     email_body = f"{args.email_message}<br><br>"
     if llm_summary:
         email_body += f"<pre>{llm_summary}</pre>"
@@ -590,25 +2452,41 @@ if args.recipients and not args.local:
     )
 
     logger.info("Email sent")
+    memory_checkpoint("email")
 
 else:
     print(f"{llm_summary}\n")
-    report = [f"Issue count: {issue_count}\n\n"]
+    render_start = perf_counter()
+    report = [f"Issue count: {issue_count_text}\n\n"]
+    for heading, lines in report_sections:
+        report.append(f"{heading}:\n")
+        report.extend(f"  {line}\n" for line in lines)
+        report.append("\n")
 
-    for item in report_list:
-        report.append("==========\n")
-        for key, value in item.items():
-            if "All Comments" in key:
-                continue
-            if "Link" not in key:
-                report.append(f"{key}: {value}\n")
-            elif "Epic" in key and item.get("Epic") and "subtask" not in str(item["Epic"]):
-                report.append(f"({value})\n")
-            elif "Epic" not in key:
-                report.append(f"({value})\n")
-        report.append("\n\n")
+    report.extend(text_fragment for _, _, _, text_fragment in report_fragments)
 
     report_message = " ".join(report)
+    del report
+    record_phase("render_text", render_start)
+    memory_checkpoint("render_text")
 
     logger.info("Email disabled; Printing query results locally only...\n")
     print(report_message)
+
+if history is not None:
+    try:
+        with timed("history"):
+            with history:
+                record_snapshot(
+                    history, run_start.isoformat(timespec="seconds"), snapshot_rows
+                )
+                if args.history_weeks:
+                    # This run is the latest, so a digest always has one to compare
+                    before = run_start - timedelta(weeks=args.history_weeks)
+                    prune_snapshots(history, before.isoformat(timespec="seconds"))
+            history.close()
+    except Exception as e:
+        logger.warning(f"Failed to update the snapshot store {args.history_db}: {e}")
+snapshot_rows = []
+
+run_outcome = "success"